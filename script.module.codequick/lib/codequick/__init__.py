@@ -36,13 +36,18 @@ from __future__ import absolute_import
 # to report total execution time
 start_time = __import__("time").time()
 
+# Opt-in startup profiler, enabled by the CODEQUICK_PROFILE environment variable
+from codequick import profiler  # noqa: E402 - imported after start_time, so the import is included in the total
+profiler.install()
+
 # Package imports
-from codequick.support import run
-from codequick.resolver import Resolver
-from codequick.listing import Listitem
-from codequick.script import Script
-from codequick.route import Route
-from codequick import utils, storage
+with profiler.phase("import codequick"):
+    from codequick.support import run
+    from codequick.resolver import Resolver
+    from codequick.listing import Listitem
+    from codequick.script import Script
+    from codequick.route import Route
+    from codequick import utils, storage
 
 __all__ = ["run", "Script", "Route", "Resolver", "Listitem", "utils", "storage"]
 __version__ = (0, 9, 5)
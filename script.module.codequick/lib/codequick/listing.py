@@ -16,20 +16,22 @@ import xbmcgui
 from codequick.script import Script
 from codequick.support import auto_sort, build_path, logger_id, dispatcher
 from codequick.utils import ensure_unicode, ensure_native_str, unicode_type, PY3, bold
+from codequick import profiler
 
 __all__ = ["Listitem"]
 
 # Logger specific to this module
 logger = logging.getLogger("%s.listitem" % logger_id)
 
-# Listitem thumbnail locations
-local_image = ensure_native_str(os.path.join(Script.get_info("path"), u"resources", u"media", u"{}"))
-global_image = ensure_native_str(os.path.join(Script.get_info("path_global"), u"resources", u"media", u"{}"))
+with profiler.phase("listing media paths"):
+    # Listitem thumbnail locations
+    local_image = ensure_native_str(os.path.join(Script.get_info("path"), u"resources", u"media", u"{}"))
+    global_image = ensure_native_str(os.path.join(Script.get_info("path_global"), u"resources", u"media", u"{}"))
 
-# Prefetch fanart/icon for use later
-_fanart = Script.get_info("fanart")
-fanart = ensure_native_str(_fanart) if os.path.exists(_fanart) else None
-icon = ensure_native_str(Script.get_info("icon"))
+    # Prefetch fanart/icon for use later
+    _fanart = Script.get_info("fanart")
+    fanart = ensure_native_str(_fanart) if os.path.exists(_fanart) else None
+    icon = ensure_native_str(Script.get_info("icon"))
 
 # Stream type map to ensure proper stream value types
 stream_type_map = {"duration": int,
@@ -598,12 +600,12 @@ class Listitem(object):
             self.params.update(kwargs)
 
     # noinspection PyProtectedMember
-    def _close(self):
+    def _close(self, path_builder=build_path):
         callback = self.path
         if hasattr(callback, "route"):
             self.listitem.setProperty("isplayable", str(callback.route.is_playable).lower())
             self.listitem.setProperty("folder", str(callback.route.is_folder).lower())
-            path = build_path(callback, self._args, self.params.raw_dict)
+            path = path_builder(callback, self._args, self.params.raw_dict)
             isfolder = callback.route.is_folder
         else:
             self.listitem.setProperty("isplayable", "true" if callback else "false")
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in startup profiler, used to find out where the start up time of an add-on goes.
+
+Enabled by setting the ``CODEQUICK_PROFILE`` environment variable. The time taken by each
+startup phase and by each module import is recorded, and reported once the add-on has finished.
+The report is logged, unless the variable is set to a file path, then the report is saved there as json.
+"""
+from __future__ import absolute_import
+
+# Standard Library Imports
+from contextlib import contextmanager
+import json
+import time
+import sys
+import os
+
+try:
+    import builtins
+except ImportError:  # pragma: no cover
+    import __builtin__ as builtins
+
+# The profiler setting, a file path if the report should be saved to disk
+setting = os.environ.get("CODEQUICK_PROFILE", "")
+enabled = bool(setting)
+
+# Recorded timings, in order of completion
+phases = []
+imports = []
+
+# Time spent in nested imports, for each import that is in progress
+_import_stack = []
+_original_import = builtins.__import__
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the time taken by the given startup phase.
+
+    :param str name: Name of the phase.
+    """
+    if not enabled:
+        yield
+    else:
+        start = time.time()
+        try:
+            yield
+        finally:
+            phases.append({"name": name, "start": start, "duration": time.time() - start})
+
+
+def _timed_import(name, *args, **kwargs):
+    # Only imports that load new modules are timed, everything else is only a lookup of sys.modules
+    fromlist = args[2] if len(args) > 2 else kwargs.get("fromlist")
+    if name in sys.modules and not (fromlist and any("{}.{}".format(name, item) not in sys.modules
+                                                     for item in fromlist if item != "*")):
+        return _original_import(name, *args, **kwargs)
+
+    _import_stack.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        duration = time.time() - start
+        nested = _import_stack.pop()
+        if _import_stack:
+            _import_stack[-1] += duration
+
+        imports.append({"module": name, "depth": len(_import_stack),
+                        "duration": duration, "self": duration - nested})
+
+
+def install():
+    """Start timing module imports, if the profiler is enabled."""
+    if enabled and builtins.__import__ is not _timed_import:
+        builtins.__import__ = _timed_import
+
+
+def uninstall():
+    """Stop timing module imports."""
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+
+
+def report(start_time):
+    """
+    Return the recorded timings as a structured report, with all times in milliseconds.
+
+    :param float start_time: The time that the add-on started, as returned by :func:`time.time`.
+    :rtype: dict
+    """
+    return {
+        "total": (time.time() - start_time) * 1000,
+        "phases": [{"name": item["name"], "offset": (item["start"] - start_time) * 1000,
+                    "duration": item["duration"] * 1000} for item in sorted(phases, key=lambda x: x["start"])],
+        "imports": [{"module": item["module"], "depth": item["depth"], "duration": item["duration"] * 1000,
+                     "self": item["self"] * 1000} for item in imports]
+    }
+
+
+def finish(start_time, logger):
+    """
+    Report the recorded timings, and stop the profiler.
+
+    :param float start_time: The time that the add-on started, as returned by :func:`time.time`.
+    :param logger: The logger to log the report to.
+    """
+    uninstall()
+    data = report(start_time)
+    if os.path.sep in setting:
+        with open(setting, "w") as stream:
+            json.dump(data, stream, indent=2)
+        logger.debug("Startup profile saved to: %s", setting)
+    else:
+        logger.debug("Startup profile, total: %ims", data["total"])
+        for item in data["phases"]:
+            logger.debug("Phase: %s: %ims (at %ims)", item["name"], item["duration"], item["offset"])
+
+        # Only the slowest imports are logged, the full list is available when saved to file
+        for item in sorted(data["imports"], key=lambda x: x["self"], reverse=True)[:20]:
+            logger.debug("Import: %s: %ims (self %ims)", item["module"], item["duration"], item["self"])
+
+    del phases[:]
+    del imports[:]
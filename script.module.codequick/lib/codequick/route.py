@@ -12,7 +12,7 @@ import xbmcplugin
 
 # Package imports
 from codequick.script import Script
-from codequick.support import logger_id, auto_sort
+from codequick.support import logger_id, auto_sort, PathBuilder
 from codequick.utils import ensure_native_str
 
 __all__ = ["Route", "validate_listitems"]
@@ -95,10 +95,11 @@ class Route(Script):
         listitems = []
         folder_counter = 0.0
         mediatypes = defaultdict(int)
+        path_builder = PathBuilder()
         for listitem in raw_listitems:
             if listitem:  # pragma: no branch
                 # noinspection PyProtectedMember
-                listitem_tuple = listitem._close()
+                listitem_tuple = listitem._close(path_builder)
                 listitems.append(listitem_tuple)
                 if listitem_tuple[2]:  # pragma: no branch
                     folder_counter += 1
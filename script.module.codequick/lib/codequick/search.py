@@ -30,7 +30,7 @@ class SavedSearches(Route):
         super(SavedSearches, self).__init__()
 
         # Persistent list of currently saved searches
-        self.search_db = PersistentList(SEARCH_DB)
+        self.search_db = PersistentList(SEARCH_DB, journal=True)
         self.register_delayed(self.close)
 
     def run(self, remove_entry=None, search=False, first_load=False, **extras):
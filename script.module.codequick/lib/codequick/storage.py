@@ -2,8 +2,16 @@
 from __future__ import absolute_import
 
 # Standard Library Imports
-from collections import MutableMapping, MutableSequence
+from collections import Mapping, MutableMapping, MutableSequence
+from contextlib import contextmanager
 from hashlib import sha1
+from io import BytesIO
+from itertools import count
+import numbers
+import struct
+import heapq
+import mmap
+import sqlite3
 import time
 import sys
 import os
@@ -13,14 +21,129 @@ try:
 except ImportError:  # pragma: no cover
     import pickle
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on windows, storage files will not be locked between processes
+    fcntl = None
+
 # Package imports
 from codequick.script import Script
-from codequick.utils import ensure_unicode
+from codequick.utils import ensure_unicode, unicode_type, PY3, _replace_file
+from codequick import profiler
 
-__all__ = ["PersistentDict", "PersistentList"]
+__all__ = ["PersistentDict", "PersistentList", "SQLiteDict", "ReadOnlyDict"]
 
 # The addon profile directory
-profile_dir = Script.get_info("profile")
+with profiler.phase("storage profile_dir"):
+    profile_dir = Script.get_info("profile")
+
+# The journal of a PersistentList is compacted into a new snapshot when it grows larger than
+# this ratio of the snapshot size, small snapshots are counted as the min size in bytes
+JOURNAL_RATIO = 2
+JOURNAL_MIN_SIZE = 4096
+
+# Header and index entry layouts of the ReadOnlyDict file format
+READONLY_MAGIC = b"CQRO"
+READONLY_HEADER = struct.Struct(">4sBI")  # magic, version, count
+READONLY_ENTRY = struct.Struct(">QQII")  # key hash, offset, key size, value size
+
+
+def _storage_path(name):
+    """
+    Return the full path to the storage file, creating any missing data directory.
+
+    :param str name: Filename or path to storage file.
+    """
+    # Filename is already a fullpath
+    if os.path.sep in name:
+        filepath = ensure_unicode(name)
+        data_dir = os.path.dirname(filepath)
+    else:
+        # Filename must be relative, joining profile directory with filename
+        filepath = os.path.join(profile_dir, ensure_unicode(name))
+        data_dir = profile_dir
+
+    # Ensure that filepath is bytes when platform type is linux/bsd
+    if not sys.platform.startswith("win"):  # pragma: no branch
+        filepath = filepath.encode("utf8")
+        data_dir = data_dir.encode("utf8")
+
+    # Create any missing data directory
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    return filepath
+
+
+def _sibling_path(filepath, suffix):
+    """Return the path of a file next to the storage file, keeping the type of the path."""
+    return filepath + (suffix.encode("utf8") if isinstance(filepath, bytes) else suffix)
+
+
+def _encode_key(key):
+    """
+    Return the canonical encoding of the key, that is the same for all keys that are equal.
+
+    Keys can be text, bytes, numbers, None or tuples of these. Numbers that are equal,
+    like ``1``, ``1.0`` and ``True``, share the same encoding.
+
+    :raises TypeError: If the key is not of a supported type.
+    """
+    if isinstance(key, unicode_type):
+        return b"s" + key.encode("utf8")
+    elif isinstance(key, bytes):
+        # Python 2 str keys are equal to their unicode equivalent
+        return (b"y" if PY3 else b"s") + key
+    elif isinstance(key, numbers.Integral) or (isinstance(key, float) and key.is_integer()):
+        return b"i" + str(int(key)).encode("ascii")
+    elif isinstance(key, float):
+        return b"f" + repr(key).encode("ascii")
+    elif key is None:
+        return b"n"
+    elif isinstance(key, tuple):
+        return b"t" + b"".join(struct.pack(">I", len(item)) + item for item in map(_encode_key, key))
+    else:
+        raise TypeError("Unsupported storage key type: {}".format(type(key).__name__))
+
+
+def _decode_key(data):
+    """Return the key from its canonical encoding."""
+    marker, data = data[:1], data[1:]
+    if marker == b"s":
+        return data.decode("utf8")
+    elif marker == b"y":
+        return data
+    elif marker == b"i":
+        return int(data)
+    elif marker == b"f":
+        return float(data)
+    elif marker == b"n":
+        return None
+    elif marker == b"t":
+        items = []
+        offset = 0
+        while offset < len(data):
+            size = struct.unpack_from(">I", data, offset)[0]
+            items.append(_decode_key(data[offset + 4:offset + 4 + size]))
+            offset += 4 + size
+        return tuple(items)
+    else:
+        raise ValueError("Unsupported storage key encoding: {!r}".format(marker))
+
+
+@contextmanager
+def _locked(filepath):
+    """Hold an exclusive lock of the storage file, shared between all processes."""
+    if fcntl is None:  # pragma: no cover
+        yield
+    else:
+        with open(_sibling_path(filepath, u".lock"), "a") as stream:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
 
 
 class _PersistentBase(object):
@@ -28,47 +151,62 @@ class _PersistentBase(object):
     Base class to handle persistent file handling.
 
     :param str name: Filename of persistence storage file.
+    :param bool track_changes: [opt] If True, only assignments and deletions mark the storage as changed.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, track_changes=False):
         super(_PersistentBase, self).__init__()
+        self._track_changes = track_changes
         self._version_string = "__codequick_storage_version__"
         self._data_string = "__codequick_storage_data__"
+        self._oldest_string = "__codequick_storage_oldest__"
         self._serializer_obj = object
+        self._filepath = _storage_path(name)
         self._stream = None
+        self._signature = None
+        self._dirty = False
         self._hash = None
         self._data = None
 
-        # Filename is already a fullpath
-        if os.path.sep in name:
-            self._filepath = ensure_unicode(name)
-            data_dir = os.path.dirname(self._filepath)
-        else:
-            # Filename must be relative, joining profile directory with filename
-            self._filepath = os.path.join(profile_dir, ensure_unicode(name))
-            data_dir = profile_dir
-
-        # Ensure that filepath is bytes when platform type is linux/bsd
-        if not sys.platform.startswith("win"):  # pragma: no branch
-            self._filepath = self._filepath.encode("utf8")
-            data_dir = data_dir.encode("utf8")
-
-        # Create any missing data directory
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-
     def _load(self):
         """Load in existing data from disk."""
         # Load storage file if exists
         if os.path.exists(self._filepath):
             self._stream = file_obj = open(self._filepath, "rb+")
-            content = file_obj.read()
+            self._signature = self._stat()
+            if self._track_changes:
+                return pickle.load(file_obj)
 
-            # Calculate hash of current file content
+            # The hash of the content is used to detect values that were modified in place
+            content = file_obj.read()
             self._hash = sha1(content).hexdigest()
 
-            # Load content and update storage
-            return pickle.loads(content)
+            # Leave the file positioned after the snapshot, as a PersistentList journal may follow it
+            buffer = BytesIO(content)
+            data = pickle.load(buffer)
+            file_obj.seek(buffer.tell())
+            return data
+
+    def _stat(self):
+        """Return a signature of the storage file, that changes whenever the file is written to."""
+        try:
+            stat = os.stat(self._filepath)
+        except OSError:
+            return None
+        else:
+            return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def _merge(self):
+        """
+        Merge in any changes that other processes have written to disk.
+
+        :returns: True if the data was changed by the merge.
+        """
+        return False
+
+    def _modified_in_place(self):
+        """Called when the data has changed, without any assignments or deletions to say what changed."""
+        self._dirty = True
 
     def flush(self):
         """
@@ -76,31 +214,51 @@ class _PersistentBase(object):
 
         Data will only be written to disk if content has changed.
         """
+        content = None
+        if not self._dirty:
+            # All mutators mark the storage as dirty, so there is nothing to serialize when tracking changes
+            if self._track_changes:
+                return None
+
+            # Values that were modified in place are only found by comparing the serialized data
+            content = pickle.dumps(self._snapshot(), protocol=2)  # Protocol 2 is used for python2/3 compatibility
+            if sha1(content).hexdigest() == self._hash:
+                return None
+            self._modified_in_place()
+
+        # Other processes may be using the same storage file
+        with _locked(self._filepath):
+            if self._merge() or content is None:
+                # Serialize the storage data
+                content = pickle.dumps(self._snapshot(), protocol=2)
+
+            # Dump data out to a temporary file, and replace the storage file with it,
+            # so that other processes will never see a partially written file
+            tmp_path = _sibling_path(self._filepath, u".tmp")
+            with open(tmp_path, "wb") as stream:
+                stream.write(content)
 
-        # Serialize the storage data
-        data = {self._version_string: 2, self._data_string: self._data}
-        content = pickle.dumps(data, protocol=2)  # Protocol 2 is used for python2/3 compatibility
-        current_hash = sha1(content).hexdigest()
-
-        # Compare saved hash with current hash, to detect if content has changed
-        if self._hash is None or self._hash != current_hash:
-            # Check if FileObj Needs Creating First
             if self._stream:
-                self._stream.seek(0)
-                self._stream.truncate(0)
-            else:
-                self._stream = open(self._filepath, "wb+")
+                self._stream.close()
+            _replace_file(tmp_path, self._filepath)
+            self._stream = open(self._filepath, "rb+")
+            self._stream.seek(0, os.SEEK_END)
+            self._signature = self._stat()
 
-            # Dump data out to disk
-            self._stream.write(content)
-            self._hash = current_hash
-            self._stream.flush()
+        if not self._track_changes:
+            self._hash = sha1(content).hexdigest()
+        self._dirty = False
+
+    def _snapshot(self):
+        """Return the storage data that will be serialized to disk."""
+        return {self._version_string: 2, self._data_string: self._data}
 
     def close(self):
         """Flush content to disk & close file object."""
         self.flush()
-        self._stream.close()
-        self._stream = None
+        if self._stream:
+            self._stream.close()
+            self._stream = None
 
     def __enter__(self):
         return self
@@ -116,9 +274,11 @@ class _PersistentBase(object):
 
     def __setitem__(self, index, value):
         self._data[index] = (value, time.time())
+        self._dirty = True
 
     def __delitem__(self, index):
         del self._data[index]
+        self._dirty = True
 
     def __bool__(self):
         return bool(self._data)
@@ -133,13 +293,18 @@ class PersistentDict(_PersistentBase, MutableMapping):
 
     :param str name: Filename or path to storage file.
     :param int ttl: [opt] The amount of time in "seconds" that a value can be stored before it expires.
+    :param bool track_changes: [opt] If True, only assignments and deletions mark the storage as changed,
+                               so an unchanged storage is never serialized on flush. Defaults to ``False``.
 
     .. note::
 
         ``name`` can be a filename, or the full path to a file.
         The add-on profile directory will be the default location for files, unless a full path is given.
 
-    .. note:: If the ``ttl`` parameter is given, "any" expired data will be removed on initialization.
+    .. note::
+
+        If the ``ttl`` parameter is given, expired data will be ignored on access and
+        removed from disk on flush, using an index of the values ordered by time.
 
     .. note:: This class is also designed as a "Context Manager".
 
@@ -148,6 +313,17 @@ class PersistentDict(_PersistentBase, MutableMapping):
         Data will only be synced to disk when connection to file is
         "closed" or when "flush" method is explicitly called.
 
+    .. note::
+
+        By default, the data is serialized on flush to find any values that were modified in place.
+        With ``track_changes``, a stored value that is modified in place must be reassigned for the
+        change to be saved.
+
+    .. note::
+
+        The storage can be shared between processes. If another process has written to the file
+        since it was loaded, the changed keys are merged with the data on disk when flushing.
+
     :Example:
         >>> with PersistentDict("dictfile.pickle") as db:
         >>>     db["testdata"] = "testvalue"
@@ -155,13 +331,22 @@ class PersistentDict(_PersistentBase, MutableMapping):
     """
 
     def __iter__(self):
-        return iter(self._data)
+        if self._ttl:
+            cutoff = time.time() - self._ttl
+            return (key for key, item in self._data.items() if item[1] > cutoff)
+        else:
+            return iter(self._data)
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
 
-    def __init__(self, name, ttl=None):
-        super(PersistentDict, self).__init__(name)
+    def __init__(self, name, ttl=None, track_changes=False):
+        super(PersistentDict, self).__init__(name, track_changes)
+        self._ttl = ttl
+        self._expiry = None
+        self._counter = count()
+        self._changed = set()
+        self._removed = set()
         data = self._load()
         self._data = {}
 
@@ -169,15 +354,107 @@ class PersistentDict(_PersistentBase, MutableMapping):
             version = data.get(self._version_string, 1)
             if version == 1:
                 self._data = {key: (val, time.time()) for key, val in data.items()}
+                self._changed.update(self._data)
+                self._dirty = True
             else:
+                self._data = data[self._data_string]
+
+    def _merge(self):
+        if self._signature != self._stat():
+            # Apply the keys changed by this process, on top of the data written by the other process
+            with open(self._filepath, "rb") as stream:
+                data = pickle.load(stream)
+            if self._version_string in data:
                 data = data[self._data_string]
-                if ttl:
-                    self._data = {key: item for key, item in data.items() if time.time() - item[1] < ttl}
-                else:
-                    self._data = data
+            else:
+                data = {key: (val, time.time()) for key, val in data.items()}
+
+            for key in self._changed:
+                data[key] = self._data[key]
+            for key in self._removed:
+                data.pop(key, None)
+
+            self._data = data
+            self._expiry = None
+            return True
+        return False
+
+    def _modified_in_place(self):
+        # Any of the values could have been modified, so they are all written over the data on disk
+        super(PersistentDict, self)._modified_in_place()
+        self._changed.update(self._data)
+
+    def _index(self):
+        """
+        Return the heap of (timestamp, count, key) entries, building it if required.
+
+        The heap is never stored, it's built from the timestamps in the data when first needed.
+        """
+        if self._expiry is None or len(self._expiry) > len(self._data) * 2 + 16:
+            # Only build when missing or when mostly made up of overwritten entries
+            self._expiry = [(item[1], next(self._counter), key) for key, item in self._data.items()]
+            heapq.heapify(self._expiry)
+        return self._expiry
+
+    def purge(self):
+        """Remove all expired data, in order of age, stopping at the first value that has not expired."""
+        if self._ttl and self._data:
+            cutoff = time.time() - self._ttl
+            expiry = self._index()
+            while expiry and expiry[0][0] <= cutoff:
+                timestamp, _, key = heapq.heappop(expiry)
+                item = self._data.get(key)
+                # The entry is outdated if the key was deleted or overwritten after it was indexed
+                if item is not None and item[1] == timestamp:
+                    del self[key]
+
+    def flush(self):
+        """
+        Synchronize data back to disk.
+
+        Data will only be written to disk if content has changed.
+        """
+        self.purge()
+        super(PersistentDict, self).flush()
+        self._changed.clear()
+        self._removed.clear()
+
+    def __len__(self):
+        if self._ttl:
+            return sum(1 for _ in self)
+        else:
+            return len(self._data)
+
+    def __bool__(self):
+        return any(True for _ in self)
+
+    def __nonzero__(self):
+        return any(True for _ in self)
+
+    def __getitem__(self, key):
+        value, timestamp = self._data[key]
+        if self._ttl and timestamp <= time.time() - self._ttl:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(PersistentDict, self).__setitem__(key, value)
+        self._removed.discard(key)
+        self._changed.add(key)
+        if self._expiry is not None:
+            heapq.heappush(self._expiry, (self._data[key][1], next(self._counter), key))
+
+    def __delitem__(self, key):
+        super(PersistentDict, self).__delitem__(key)
+        self._changed.discard(key)
+        self._removed.add(key)
 
     def items(self):
-        return map(lambda x: (x[0], x[1][0]), self._data.items())
+        if self._ttl:
+            cutoff = time.time() - self._ttl
+            return [(key, item[0]) for key, item in self._data.items() if item[1] > cutoff]
+        else:
+            return map(lambda x: (x[0], x[1][0]), self._data.items())
 
 
 class PersistentList(_PersistentBase, MutableSequence):
@@ -186,13 +463,20 @@ class PersistentList(_PersistentBase, MutableSequence):
 
     :param str name: Filename or path to storage file.
     :param int ttl: [opt] The amount of time in "seconds" that a value can be stored before it expires.
+    :param bool journal: [opt] If True, changes are appended to the end of the file instead of rewriting it.
+    :param bool track_changes: [opt] If True, only assignments and deletions mark the storage as changed,
+                               so an unchanged storage is never serialized on flush. Always used in journal mode.
+                               Defaults to ``False``.
 
     .. note::
 
         ``name`` can be a filename, or the full path to a file.
         The add-on profile directory will be the default location for files, unless a full path is given.
 
-    .. note:: If the ``ttl`` parameter is given, "any" expired data will be removed on initialization.
+    .. note::
+
+        If the ``ttl`` parameter is given, expired data will be removed on initialization.
+        The list is only scanned if the oldest value has expired.
 
     .. note:: This class is also designed as a "Context Manager".
 
@@ -201,6 +485,18 @@ class PersistentList(_PersistentBase, MutableSequence):
         Data will only be synced to disk when connection to file is
         "closed" or when "flush" method is explicitly called.
 
+    .. note::
+
+        By default, the data is serialized on flush to find any values that were modified in place.
+        With ``track_changes`` or in journal mode, a stored value that is modified in place must be
+        reassigned for the change to be saved.
+
+    .. note::
+
+        In journal mode, the cost of a flush depends on the number of changes, not the length of the list.
+        The journal is compacted into a new snapshot once it grows larger than :data:`JOURNAL_RATIO` times
+        the size of the snapshot, or of :data:`JOURNAL_MIN_SIZE` if the snapshot is smaller than that.
+
     :Example:
         >>> with PersistentList("listfile.pickle") as db:
         >>>     db.append("testvalue")
@@ -211,23 +507,435 @@ class PersistentList(_PersistentBase, MutableSequence):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, [val for val, _ in self._data])
 
-    def __init__(self, name, ttl=None):
-        super(PersistentList, self).__init__(name)
+    def __init__(self, name, ttl=None, journal=False, track_changes=False):
+        # Only assignments and deletions can be journaled
+        super(PersistentList, self).__init__(name, track_changes or journal)
+        self._journal = [] if journal else None
+        self._snapshot_size = 0
+        self._journal_size = 0
         data = self._load()
         self._data = []
 
         if data:
             if isinstance(data, list):
                 self._data = [(val, time.time()) for val in data]
+                self._dirty = True
             else:
-                data = data[self._data_string]
-                if ttl:
-                    self._data = [item for item in data if time.time() - item[1] < ttl]
-                else:
-                    self._data = data
+                self._data = data[self._data_string]
+                self._snapshot_size = self._stream.tell()
+                self._replay()
+
+                # The time of the oldest value is stored, so the full list
+                # only needs to be scanned when there is something to remove
+                cutoff = time.time() - ttl if ttl else None
+                oldest = data.get(self._oldest_string, 0)
+                if ttl and oldest is not None and oldest <= cutoff:
+                    size = len(self._data)
+                    self._data = [item for item in self._data if item[1] > cutoff]
+                    self._dirty = self._dirty or len(self._data) != size
+
+        # Any change made while loading requires the full list to be written
+        self._compact = self._dirty
+
+    def _replay(self):
+        """Apply the journal records that were appended after the snapshot."""
+        content = self._stream.read()
+        journal = BytesIO(content)
+        data = self._data
+        while journal.tell() < len(content):
+            try:
+                record = pickle.load(journal)
+            except (EOFError, pickle.UnpicklingError):
+                # A partially written record, the file is repaired by writing a new snapshot
+                self._dirty = True
+                break
+
+            if record[0] == "insert":
+                data.insert(record[1], record[2])
+            elif record[0] == "set":
+                data[record[1]] = record[2]
+            else:
+                del data[record[1]]
+
+        self._journal_size = len(content)
+
+    def _snapshot(self):
+        data = super(PersistentList, self)._snapshot()
+        data[self._oldest_string] = min(item[1] for item in self._data) if self._data else None
+        return data
+
+    def _record(self, *record):
+        """Add a change to the journal, if in journal mode."""
+        self._dirty = True
+        if self._journal is not None and not self._compact:
+            if isinstance(record[1], slice):
+                # Slices are not journaled, the full list is written instead
+                self._compact = True
+            else:
+                self._journal.append(record)
+
+    def flush(self):
+        """
+        Synchronize data back to disk.
+
+        Data will only be written to disk if content has changed.
+        """
+        if self._dirty and self._journal is not None and not self._compact and self._stream:
+            content = b"".join(pickle.dumps(record, protocol=2) for record in self._journal)
+            if self._journal_size + len(content) <= max(self._snapshot_size, JOURNAL_MIN_SIZE) * JOURNAL_RATIO:
+                with _locked(self._filepath):
+                    # The journal can only be appended to, if the file was not replaced by another process
+                    if self._signature == self._stat():
+                        self._stream.seek(0, os.SEEK_END)
+                        self._stream.write(content)
+                        self._stream.flush()
+                        self._signature = self._stat()
+                        self._journal_size += len(content)
+                        self._dirty = False
+                        del self._journal[:]
+                        return None
+
+        dirty = self._dirty
+        super(PersistentList, self).flush()
+        if dirty:
+            # The snapshot now contains all changes, so the journal starts again
+            self._snapshot_size = self._stream.tell()
+            self._journal_size = 0
+            self._compact = False
+            if self._journal is not None:
+                del self._journal[:]
+
+    def __setitem__(self, index, value):
+        super(PersistentList, self).__setitem__(index, value)
+        self._record("set", index, self._data[index])
+
+    def __delitem__(self, index):
+        super(PersistentList, self).__delitem__(index)
+        self._record("del", index)
 
     def insert(self, index, value):
-        self._data.insert(index, (value, time.time()))
+        item = (value, time.time())
+        self._data.insert(index, item)
+        self._record("insert", index, item)
 
     def append(self, value):
-        self._data.append((value, time.time()))
+        item = (value, time.time())
+        self._record("insert", len(self._data), item)
+        self._data.append(item)
+
+
+class SQLiteDict(MutableMapping):
+    """
+    Persistent storage with a :class:`dictionary<dict>` like interface, backed by a SQLite database.
+
+    Unlike :class:`PersistentDict`, values are only loaded from disk when they are accessed, and
+    only the keys that changed are written to disk on flush. So the cost of opening and flushing
+    the storage depends on what was used, not on the size of the storage. Values are pickled.
+
+    :param str name: Filename or path to storage file.
+    :param int ttl: [opt] The amount of time in "seconds" that a value can be stored before it expires.
+
+    .. note::
+
+        ``name`` can be a filename, or the full path to a file.
+        The add-on profile directory will be the default location for files, unless a full path is given.
+
+    .. note:: If the ``ttl`` parameter is given, expired data will be ignored and removed on flush.
+
+    .. note:: This class is also designed as a "Context Manager".
+
+    .. note::
+
+        Data will only be synced to disk when connection to file is
+        "closed" or when "flush" method is explicitly called.
+
+    :Example:
+        >>> with SQLiteDict("dictfile.sqlite") as db:
+        >>>     db["testdata"] = "testvalue"
+        >>>     db.flush()
+    """
+
+    def __init__(self, name, ttl=None):
+        super(SQLiteDict, self).__init__()
+        self._filepath = _storage_path(name)
+        self._ttl = ttl
+        self._cache = {}
+        self._dirty = set()
+        self._deleted = set()
+
+        self._db = db = sqlite3.connect(self._filepath, timeout=5)
+        db.text_factory = bytes
+        db.execute("CREATE TABLE IF NOT EXISTS storage (key BLOB PRIMARY KEY, value BLOB, timestamp REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS storage_timestamp ON storage (timestamp)")
+        db.commit()
+
+    @staticmethod
+    def _dumps(obj):
+        # Protocol 2 is used for python2/3 compatibility
+        return sqlite3.Binary(pickle.dumps(obj, protocol=2))
+
+    @staticmethod
+    def _key(key):
+        """Return the key with bytes decoded to unicode, so "a" and u"a" are the same key on all python versions."""
+        return ensure_unicode(key) if isinstance(key, bytes) else key
+
+    def _expire_time(self):
+        """Return the timestamp that values older than have expired."""
+        return time.time() - self._ttl if self._ttl else 0
+
+    def _fetch(self, key):
+        """Return the (value, timestamp) of the key, loading from disk if required."""
+        key = self._key(key)
+        if key in self._cache:
+            return self._cache[key]
+        elif key in self._deleted:
+            raise KeyError(key)
+
+        try:
+            encoded = sqlite3.Binary(_encode_key(key))
+        except TypeError:
+            # Keys of unsupported types can never have been stored
+            raise KeyError(key)
+
+        row = self._db.execute("SELECT value, timestamp FROM storage WHERE key = ? AND timestamp >= ?",
+                               (encoded, self._expire_time())).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        self._cache[key] = item = (pickle.loads(bytes(row[0])), row[1])
+        return item
+
+    def __getitem__(self, key):
+        return self._fetch(key)[0]
+
+    def __setitem__(self, key, value):
+        key = self._key(key)
+        _encode_key(key)  # Unsupported keys are rejected straight away, instead of on flush
+        self._cache[key] = (value, time.time())
+        self._deleted.discard(key)
+        self._dirty.add(key)
+
+    def __delitem__(self, key):
+        key = self._key(key)
+        self._fetch(key)
+        del self._cache[key]
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        try:
+            self._fetch(key)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __iter__(self):
+        # Keys are decoded, but values are not loaded
+        keys = set(self._dirty)
+        cursor = self._db.execute("SELECT key FROM storage WHERE timestamp >= ?", (self._expire_time(),))
+        keys.update(_decode_key(bytes(row[0])) for row in cursor)
+        return iter(keys - self._deleted)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return any(True for _ in self)
+
+    def __nonzero__(self):
+        return any(True for _ in self)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def flush(self):
+        """
+        Synchronize data back to disk.
+
+        Only the keys that have changed are written to disk.
+        """
+        if self._dirty or self._deleted or self._ttl:
+            db = self._db
+            with db:
+                db.executemany("INSERT OR REPLACE INTO storage (key, value, timestamp) VALUES (?, ?, ?)",
+                               [(sqlite3.Binary(_encode_key(key)), self._dumps(self._cache[key][0]),
+                                 self._cache[key][1]) for key in self._dirty])
+                db.executemany("DELETE FROM storage WHERE key = ?",
+                               [(sqlite3.Binary(_encode_key(key)),) for key in self._deleted])
+                if self._ttl:
+                    db.execute("DELETE FROM storage WHERE timestamp < ?", (self._expire_time(),))
+
+            self._dirty.clear()
+            self._deleted.clear()
+
+    def close(self):
+        """Flush content to disk & close the database."""
+        self.flush()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ReadOnlyDict(Mapping):
+    """
+    Read only storage with a :class:`dictionary<dict>` like interface, for large lookup tables.
+
+    The storage file is memory mapped, and contains an index of the keys sorted by hash.
+    Only the entry that was requested is decoded, so opening the storage costs the same no matter
+    how large it is. The storage file is created with the :meth:`build` method.
+
+    Keys can be text, bytes, numbers, None or tuples of these. Keys that are equal are always the same key.
+
+    :param str name: Filename or path to storage file.
+
+    .. note::
+
+        ``name`` can be a filename, or the full path to a file.
+        The add-on profile directory will be the default location for files, unless a full path is given.
+
+    .. note:: This class is also designed as a "Context Manager".
+
+    :Example:
+        >>> ReadOnlyDict.build("channels.index", {"bbc1": "BBC One", "bbc2": "BBC Two"})
+        >>> with ReadOnlyDict("channels.index") as db:
+        >>>     name = db["bbc1"]
+    """
+
+    def __init__(self, name):
+        super(ReadOnlyDict, self).__init__()
+        self._filepath = _storage_path(name)
+        self._stream = None
+        self._mmap = None
+        self._len = 0
+
+        # A missing storage file is treated as empty
+        if os.path.exists(self._filepath):
+            self._stream = open(self._filepath, "rb")
+            if os.fstat(self._stream.fileno()).st_size < READONLY_HEADER.size:
+                self.close()
+                raise ValueError("Unsupported storage file format: {}".format(name))
+
+            self._mmap = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self._len = READONLY_HEADER.unpack_from(self._mmap, 0)
+            if magic != READONLY_MAGIC or version != 1:
+                self.close()
+                raise ValueError("Unsupported storage file format: {}".format(name))
+
+    @staticmethod
+    def _hash(key):
+        """
+        Return the 64bit hash of the key, that is stable across sessions and python versions.
+
+        :raises TypeError: If the key is not of a supported type.
+        """
+        return struct.unpack(">Q", sha1(_encode_key(key)).digest()[:8])[0]
+
+    @classmethod
+    def build(cls, name, data):
+        """
+        Create the storage file from the given mapping, replacing any existing file.
+
+        :param str name: Filename or path to storage file.
+        :param data: A :class:`dictionary<dict>` or any other mapping of the data to store.
+        :raises TypeError: If any of the keys are not of a supported type.
+        """
+        filepath = _storage_path(name)
+
+        # Protocol 2 is used for python2/3 compatibility
+        records = sorted((cls._hash(key), pickle.dumps(key, protocol=2), pickle.dumps(value, protocol=2))
+                         for key, value in data.items())
+
+        # The records are stored in the same order as the index, right after it
+        offset = READONLY_HEADER.size + READONLY_ENTRY.size * len(records)
+        index = []
+        for key_hash, key_data, value_data in records:
+            index.append(READONLY_ENTRY.pack(key_hash, offset, len(key_data), len(value_data)))
+            offset += len(key_data) + len(value_data)
+
+        # Write to a temporary file first, so that readers never see a partial file
+        tmp_path = _sibling_path(filepath, u".tmp")
+        with open(tmp_path, "wb") as stream:
+            stream.write(READONLY_HEADER.pack(READONLY_MAGIC, 1, len(records)))
+            stream.write(b"".join(index))
+            for _, key_data, value_data in records:
+                stream.write(key_data)
+                stream.write(value_data)
+
+        _replace_file(tmp_path, filepath)
+
+    def _entry(self, position):
+        """Return the index entry at the given position."""
+        return READONLY_ENTRY.unpack_from(self._mmap, READONLY_HEADER.size + READONLY_ENTRY.size * position)
+
+    def _find(self, key):
+        """Return the index entry of the given key."""
+        try:
+            key_hash = self._hash(key)
+        except TypeError:
+            # Keys of unsupported types can never have been stored
+            raise KeyError(key)
+
+        # Binary search for the first entry with a matching hash
+        low, high = 0, self._len
+        while low < high:
+            mid = (low + high) // 2
+            if self._entry(mid)[0] < key_hash:
+                low = mid + 1
+            else:
+                high = mid
+
+        # Different keys can share the same hash, so the key itself is compared
+        while low < self._len:
+            entry = self._entry(low)
+            if entry[0] != key_hash:
+                break
+            elif pickle.loads(self._mmap[entry[1]:entry[1] + entry[2]]) == key:
+                return entry
+            low += 1
+
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        _, offset, key_size, value_size = self._find(key)
+        offset += key_size
+        return pickle.loads(self._mmap[offset:offset + value_size])
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __iter__(self):
+        for position in range(self._len):
+            _, offset, key_size, _ = self._entry(position)
+            yield pickle.loads(self._mmap[offset:offset + key_size])
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def close(self):
+        """Close the memory map & file object."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._len = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -2,13 +2,23 @@
 from __future__ import absolute_import
 
 # Standard Library Imports
+import importlib
 import binascii
 import logging
+import tempfile
 import inspect
+import base64
 import pickle
+import json
 import time
 import sys
 import re
+import os
+
+try:
+    from urllib.parse import quote
+except ImportError:  # pragma: no cover
+    from urllib import quote
 
 # Kodi imports
 import xbmcaddon
@@ -16,10 +26,12 @@ import xbmcgui
 import xbmc
 
 # Package imports
-from codequick.utils import parse_qs, ensure_native_str, urlparse, PY3
+from codequick.utils import parse_qs, ensure_native_str, urlparse, unicode_type, PY3, _replace_file
+from codequick import profiler
 
-script_data = xbmcaddon.Addon("script.module.codequick")
-addon_data = xbmcaddon.Addon()
+with profiler.phase("xbmcaddon.Addon"):
+    script_data = xbmcaddon.Addon("script.module.codequick")
+    addon_data = xbmcaddon.Addon()
 
 plugin_id = addon_data.getAddonInfo("id")
 logger_id = re.sub("[ .]", "-", addon_data.getAddonInfo("name"))
@@ -30,6 +42,21 @@ logger = logging.getLogger("%s.support" % logger_id)
 # Listitem auto sort methods
 auto_sort = set()
 
+# Name of the query parameter that holds the encoded parameters that can not be plain urlencoded.
+# The first character of the value selects the codec, "j" for json and "p" for pickle.
+PARAMS_KEY = "_cq_"
+
+# Types that can be urlencoded as is, and types that will survive a round trip through json.
+# Text comes back from json as unicode, the same as the values that are urlencoded as is.
+TEXT_TYPES = (str, unicode_type)
+JSON_TYPES = TEXT_TYPES + ((bool, int, float, type(None)) if PY3 else (bool, int, long, float, type(None)))  # noqa
+
+# Name of the file, in the add-on profile directory, that maps route paths to the modules that register them
+ROUTE_MANIFEST = u"_routes.json"
+
+# Time in seconds that housekeeping tasks are allowed to run for, per invocation
+MAINTENANCE_BUDGET = 1.0
+
 
 class LoggingMap(dict):
     def __init__(self):
@@ -97,7 +124,7 @@ class Route(object):
     :ivar parent: The parent class that will handle the response from callback.
     :ivar str path: The route path to func/class.
     """
-    __slots__ = ("parent", "function", "callback", "path", "is_playable", "is_folder")
+    __slots__ = ("parent", "function", "callback", "path", "is_playable", "is_folder", "_arg_names", "_positional")
 
     def __init__(self, callback, parent, path):
         # Register a class callback
@@ -119,19 +146,21 @@ class Route(object):
         self.callback = callback
         self.path = path
 
+        # Inspect the callback arguments once, the first argument is always the parent instance
+        if PY3:
+            self._arg_names = tuple(inspect.getfullargspec(self.function).args)
+        else:
+            # noinspection PyDeprecation
+            self._arg_names = tuple(inspect.getargspec(self.function).args)
+        self._positional = self._arg_names[1:]
+
     def args_to_kwargs(self, args, kwargs):  # type: (tuple, dict) -> None
         """Convert positional arguments to keyword arguments and merge into callback parameters."""
-        callback_args = self.arg_names()[1:]
-        arg_map = zip(callback_args, args)
-        kwargs.update(arg_map)
+        kwargs.update(zip(self._positional, args))
 
     def arg_names(self):  # type: () -> list
         """Return a list of argument names, positional and keyword arguments."""
-        if PY3:
-            return inspect.getfullargspec(self.function).args
-        else:
-            # noinspection PyDeprecation
-            return inspect.getargspec(self.function).args
+        return list(self._arg_names)
 
     def unittest_caller(self, *args, **kwargs):
         """
@@ -176,6 +205,7 @@ class Route(object):
             # Execute Delated callback functions if any
             if execute_delayed:
                 dispatcher.run_delayed()
+                dispatcher.run_maintenance()
 
             return results
 
@@ -189,6 +219,7 @@ class Dispatcher(object):
     """Class to handle registering and dispatching of callback functions."""
 
     def __init__(self):
+        self.registered_maintenance = []
         self.registered_delayed = []
         self.registered_routes = {}
         self.callback_params = {}
@@ -198,6 +229,7 @@ class Dispatcher(object):
 
     def reset(self):
         """Reset session parameters."""
+        self.registered_maintenance[:] = []
         self.registered_delayed[:] = []
         self.callback_params.clear()
         kodi_logger.debug_msgs = []
@@ -215,7 +247,11 @@ class Dispatcher(object):
             params = parse_qs(raw_params)
             self.params.update(params)
 
-            # Unpickle pickled data
+            # Decode any parameters that could not be urlencoded
+            if PARAMS_KEY in params:
+                self.params.update(decode_params(self.params.pop(PARAMS_KEY)))
+
+            # Unpickle pickled data, from urls built by older versions
             if "_pickle_" in params:
                 unpickled = pickle.loads(binascii.unhexlify(self.params.pop("_pickle_")))
                 self.params.update(unpickled)
@@ -254,7 +290,68 @@ class Dispatcher(object):
         callback = (func, args, kwargs)
         self.registered_delayed.append(callback)
 
-    def run_callback(self):
+    def register_maintenance(self, func):
+        """
+        Register a housekeeping task, that will be called after all delayed callbacks.
+
+        The task will be called with a deadline, as returned by :func:`time.time`, after which it should
+        stop doing any more work. Any unfinished work can then be picked up again on the next invocation.
+        """
+        self.registered_maintenance.append(func)
+
+    def import_route(self, modules):
+        """
+        Import the module that registers the selected route, if not already registered.
+
+        A manifest of route paths to module names is cached in the add-on profile directory, so
+        only the module that owns the route needs to be imported. When the route is missing from
+        the manifest, all given modules are imported and the manifest is rebuilt.
+
+        :param list modules: Names of the modules that register route callbacks.
+        """
+        if self.selector in self.registered_routes:
+            return None
+
+        profile_dir = ensure_native_str(xbmc.translatePath(addon_data.getAddonInfo("profile")))
+        manifest_path = os.path.join(profile_dir, ensure_native_str(ROUTE_MANIFEST))
+        version = addon_data.getAddonInfo("version")
+        try:
+            with open(manifest_path, "r") as stream:
+                manifest = json.load(stream)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+
+        # The manifest is only valid for the add-on version it was built with
+        if manifest.get("version") == version:
+            module = manifest.get("routes", {}).get(self.selector)
+            if module in modules:
+                importlib.import_module(module)
+                if self.selector in self.registered_routes:
+                    return None
+
+        logger.debug("Rebuilding route manifest")
+        for module in modules:
+            importlib.import_module(module)
+
+        routes = {path: route.callback.__module__ for path, route in self.registered_routes.items()
+                  if route.callback.__module__ in modules}
+        try:
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+
+            # Each process writes to its own temp file, so a concurrent reader only ever sees a complete manifest
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=profile_dir)
+            try:
+                with os.fdopen(fd, "w") as stream:
+                    json.dump({"version": version, "routes": routes}, stream)
+                _replace_file(tmp_path, manifest_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            logger.debug("Unable to save route manifest: %s", e)
+
+    def run_callback(self, modules=None):
         """
         The starting point of the add-on.
 
@@ -263,23 +360,34 @@ class Dispatcher(object):
 
         The "root" callback, is the callback that will be the initial
         starting point for the add-on.
+
+        :param list modules: [opt] Names of modules that register route callbacks. These modules will not
+                             need to be imported by the add-on, only the module that owns the selected
+                             route will be imported.
         """
         self.reset()
-        self.parse_args()
+        with profiler.phase("parse_args"):
+            self.parse_args()
         logger.debug("Dispatching to route: '%s'", self.selector)
         logger.debug("Callback parameters: '%s'", self.callback_params)
 
         try:
+            if modules:
+                with profiler.phase("import_route"):
+                    self.import_route(modules)
+
             # Fetch the controling class and callback function/method
             route = self.get_route()
             execute_time = time.time()
 
             # Initialize controller and execute callback
-            parent_ins = route.parent()
-            results = route.function(parent_ins, **self.callback_params)
+            with profiler.phase("callback"):
+                parent_ins = route.parent()
+                results = route.function(parent_ins, **self.callback_params)
             if hasattr(parent_ins, "_process_results"):
-                # noinspection PyProtectedMember
-                parent_ins._process_results(results)
+                with profiler.phase("process_results"):
+                    # noinspection PyProtectedMember
+                    parent_ins._process_results(results)
 
         except Exception as e:
             # Log the error in both the gui and the kodi log file
@@ -291,10 +399,22 @@ class Dispatcher(object):
             from . import start_time
             logger.debug("Route Execution Time: %ims", (time.time() - execute_time) * 1000)
             logger.debug("Total Execution Time: %ims", (time.time() - start_time) * 1000)
-            self.run_delayed()
+            with profiler.phase("delayed"):
+                self.run_delayed()
+            with profiler.phase("maintenance"):
+                self.run_maintenance()
+
+        if profiler.enabled:
+            from . import start_time
+            profiler.finish(start_time, logger)
 
     def run_delayed(self):
         """Execute all delayed callbacks, if any."""
+        # Refresh any stale responses that urlquick returned from its cache, after all other callbacks
+        urlquick = sys.modules.get("urlquick")
+        if urlquick is not None and hasattr(urlquick, "revalidate"):
+            self.registered_delayed.insert(0, (urlquick.revalidate, [], {}))
+
         if self.registered_delayed:
             # Time before executing callbacks
             start_time = time.time()
@@ -311,6 +431,129 @@ class Dispatcher(object):
             # Log execution time of callbacks
             logger.debug("Callbacks Execution Time: %ims", (time.time() - start_time) * 1000)
 
+    def run_maintenance(self):
+        """Execute all housekeeping tasks, sharing the time budget between them."""
+        tasks = self.registered_maintenance
+
+        # Only maintain the urlquick cache if urlquick was used
+        urlquick = sys.modules.get("urlquick")
+        if urlquick is not None and hasattr(urlquick, "cache_maintenance"):
+            tasks.append(urlquick.cache_maintenance)
+
+        if tasks:
+            start_time = time.time()
+            deadline = start_time + MAINTENANCE_BUDGET
+
+            # Execute in order of first in first out (FIFO), every task is called so it can cleanup after itself
+            while tasks:
+                func = tasks.pop(0)
+                try:
+                    func(deadline)
+                except Exception as e:
+                    logger.exception(str(e))
+
+            logger.debug("Maintenance Execution Time: %ims", (time.time() - start_time) * 1000)
+
+
+def encode_params(params, quoted_keys=None):
+    """
+    Encode the parameters into a url query string.
+
+    String values are urlencoded as is. Any other values, including empty strings, are encoded together under
+    the :data:`PARAMS_KEY` parameter, as base64url encoded json if only text and simple scalar types, else pickle.
+
+    :param dict params: The parameters to encode.
+    :param dict quoted_keys: [opt] Cache of urlencoded keys, to share between calls.
+    :return: The url query string.
+    :rtype: str
+    """
+    quoted_keys = {} if quoted_keys is None else quoted_keys
+    plain = []
+    extra = {}
+    for key, value in params.items():
+        if isinstance(key, TEXT_TYPES) and isinstance(value, TEXT_TYPES) and value and key != PARAMS_KEY:
+            prefix = quoted_keys.get(key)
+            if prefix is None:
+                quoted_keys[key] = prefix = quote(ensure_native_str(key), "") + "="
+            plain.append(prefix + quote(ensure_native_str(value), ""))
+        else:
+            extra[key] = value
+
+    if extra:
+        data = None
+        if all(isinstance(key, TEXT_TYPES) and type(value) in JSON_TYPES for key, value in extra.items()):
+            try:
+                data = b"j" + json.dumps(extra, separators=(",", ":")).encode("utf8")
+            except UnicodeDecodeError:  # pragma: no cover
+                # A python 2 str that is not valid utf8 can only be pickled
+                pass
+
+        if data is None:
+            # Protocol 2 is used for python2/3 compatibility
+            data = b"p" + pickle.dumps(extra, protocol=2)
+
+        data = data[:1] + base64.urlsafe_b64encode(data[1:]).rstrip(b"=")
+        plain.append("{}={}".format(PARAMS_KEY, data.decode("ascii") if PY3 else data))
+
+    return "&".join(plain)
+
+
+def decode_params(data):
+    """
+    Decode the parameters that were encoded under the :data:`PARAMS_KEY` parameter by :func:`encode_params`.
+
+    :param str data: The value of the encoded parameter.
+    :return: The decoded parameters.
+    :rtype: dict
+    """
+    codec, data = data[:1], data[1:].encode("ascii")
+    data = base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+    if codec == u"j":
+        return json.loads(data.decode("utf8"))
+    elif codec == u"p":
+        return pickle.loads(data)
+    else:
+        raise ValueError("unsupported parameter codec: '%s'" % codec)
+
+
+class PathBuilder(object):
+    """
+    Build addon urls for a whole listing, for use when closing listitems.
+
+    The url prefix of each route and the urlencoded parameter names are built once and reused.
+    The parameter values are still encoded for every url.
+    """
+
+    def __init__(self):
+        self._prefixes = {}
+        self._quoted_keys = {}
+
+    def __call__(self, callback, args=None, query=None):
+        """
+        Build addon url for the callback.
+
+        :param callback: The callback object.
+        :param tuple args: [opt] Positional arguments that will be add to plugin path.
+        :param dict query: [opt] A set of query key/value pairs to add to plugin path.
+
+        :return: Plugin url for kodi.
+        :rtype: str
+        """
+        route = callback.route
+        try:
+            prefix = self._prefixes[route.path]
+        except KeyError:
+            prefix = self._prefixes[route.path] = urlparse.urlunsplit(("plugin", plugin_id, route.path, "", ""))
+
+        # Convert args to keyword args if required
+        if args:
+            route.args_to_kwargs(args, query)
+
+        if query:
+            return "{}?{}".format(prefix, encode_params(query, self._quoted_keys))
+        else:
+            return prefix
+
 
 def build_path(callback=None, args=None, query=None, **extra_query):
     """
@@ -338,10 +581,9 @@ def build_path(callback=None, args=None, query=None, **extra_query):
         query = dispatcher.params.copy()
         query.update(extra_query)
 
-    # Encode the query parameters using json
+    # Encode the query parameters
     if query:
-        pickled = binascii.hexlify(pickle.dumps(query, protocol=pickle.HIGHEST_PROTOCOL))
-        query = "_pickle_={}".format(pickled.decode("ascii") if PY3 else pickled)
+        query = encode_params(query)
 
     # Build kodi url with new path and query parameters
     return urlparse.urlunsplit(("plugin", plugin_id, route.path, query, ""))
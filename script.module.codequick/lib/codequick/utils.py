@@ -4,6 +4,7 @@ from __future__ import absolute_import
 # Standard Library Imports
 import sys
 import re
+import os
 
 # Kodi imports
 import xbmc
@@ -209,6 +210,17 @@ def ensure_unicode(data, encoding="utf8"):
     return data.decode(encoding) if isinstance(data, bytes) else unicode_type(data)
 
 
+def _replace_file(src, dst):
+    """Atomically replace dst with src, where the platform allows."""
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # Python 2 on windows will not rename over an existing file
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def bold(text):
     """
     Return Bolded text.
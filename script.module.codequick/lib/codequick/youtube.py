@@ -5,6 +5,7 @@ from __future__ import absolute_import
 import logging
 import sqlite3
 import json
+import time
 import os
 
 # Package imports
@@ -12,7 +13,7 @@ from codequick.route import Route
 from codequick.utils import bold
 from codequick.listing import Listitem
 from codequick.resolver import Resolver
-from codequick.support import logger_id
+from codequick.support import logger_id, dispatcher
 import urlquick
 
 # Logger specific to this module
@@ -108,8 +109,12 @@ class Database(object):
         self.cur.close()
         self.db.close()
 
-    def cleanup(self):
-        """Trim down the cache if cache gets too big."""
+    def cleanup(self, deadline=None):
+        """
+        Trim down the cache if cache gets too big.
+
+        :param float deadline: [opt] Time after which the database should not be compacted.
+        """
         # Registor cleanup if the database has more than 10,000 videos stored
         if self.cur.execute("SELECT COUNT(*) FROM videos").fetchone()[0] > 10000:
             logger.debug("Running Youtube Cache Cleanup")
@@ -124,8 +129,13 @@ class Database(object):
                           WHERE channel_id not in (SELECT channel_id from videos))"""
             self.execute(self.cur.execute, sqlquery)
 
-            # Compact the database using vacuum
-            self.cur.execute("VACUUM")
+        # Compact the database using vacuum, once a quarter of the database is unused. This is the slow part,
+        # so it's left for a later invocation if there is no time left. The free pages will still be there then.
+        if deadline is None or time.time() < deadline:
+            free_pages = self.cur.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages and free_pages * 4 > self.cur.execute("PRAGMA page_count").fetchone()[0]:
+                logger.debug("Compacting Youtube Cache")
+                self.cur.execute("VACUUM")
 
         self.close()
 
@@ -361,7 +371,7 @@ class APIControl(Route):
     def __init__(self):
         super(APIControl, self).__init__()
         self.db = Database()
-        self.register_delayed(self.db.cleanup)
+        dispatcher.register_maintenance(self.db.cleanup)
         self.api = API()
 
     def valid_playlistid(self, contentid):
@@ -39,6 +39,8 @@ have. Hence the reason for this project.
 All GET, HEAD and POST requests are cached locally for a period of 4 hours. When the cache expires,
 conditional headers are added to a new request e.g. "Etag" and "Last-modified". Then if the server
 returns a 304 Not-Modified response, the cache is reused, saving having to re-download the content body.
+Cache housekeeping is never done while making a request, call :func:`cache_maintenance` when there is
+time to spare, to remove stale cache files and keep the cache within :data:`MAX_CACHE_SIZE`.
 
 Inspired by: urlfetch & requests
 urlfetch: https://github.com/ifduyue/urlfetch
@@ -51,25 +53,39 @@ Code Coverage: https://coveralls.io/github/willforde/urlquick?branch=master
 Codacy: https://app.codacy.com/app/willforde/urlquick/dashboard
 """
 
-__all__ = ["request", "get", "head", "post", "put", "patch", "delete", "cache_cleanup", "Session"]
+__all__ = ["request", "get", "head", "post", "put", "patch", "delete", "fetch_all", "cache_cleanup",
+           "cache_evict", "cache_maintenance", "revalidate", "Session"]
 __version__ = "0.9.3"
 
 # Standard library imports
-from collections import MutableMapping, defaultdict
-from codecs import open as _open, getencoder
+from collections import MutableMapping, OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from codecs import getencoder, getincrementaldecoder
+from functools import partial
 from base64 import b64encode, b64decode
+from email.utils import parsedate_tz, mktime_tz
 from datetime import datetime
+from io import BytesIO
 import json as _json
 import logging
 import hashlib
 import socket
+import struct
+import threading
 import time
 import zlib
 import ssl
 import sys
+import select
 import re
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, the cache will only be locked within the process
+    fcntl = None
+
 # Check python version to set the object that can detect non unicode strings
 py3 = sys.version_info >= (3, 0)
 if py3:
@@ -79,6 +95,8 @@ if py3:
     from urllib.parse import urlsplit, urlunsplit, urljoin, SplitResult, urlencode, parse_qsl, quote, unquote
     # noinspection PyUnresolvedReferences
     from http.cookies import SimpleCookie
+    # noinspection PyUnresolvedReferences
+    from queue import Queue, Empty
 
     # noinspection PyShadowingBuiltins
     unicode = str
@@ -91,6 +109,8 @@ else:
     from urllib import urlencode as _urlencode, quote as _quote, unquote as _unquote
     # noinspection PyUnresolvedReferences
     from Cookie import SimpleCookie
+    # noinspection PyUnresolvedReferences
+    from Queue import Queue, Empty
 
 
     def quote(data, safe=b"/", encoding="utf8", errors="strict"):
@@ -134,9 +154,47 @@ CACHEABLE_METHODS = (u"GET", u"HEAD", u"POST")
 CACHEABLE_CODES = (200, 203, 204, 300, 301, 302, 303, 307, 308, 410, 414)
 REDIRECT_CODES = (301, 302, 303, 307, 308)
 
+# Response headers that a 304 Not Modified response can update in the cache
+FRESHNESS_HEADERS = (u"Cache-Control", u"Expires", u"Age", u"ETag", u"Last-Modified")
+
 #: The default max age of the cache in seconds is used when no max age is given in request.
 MAX_AGE = 14400  # 4 Hours
 
+# Binary cache file layout. A fixed size header, followed by the reason phrase,
+# the headers block and then the body. Bump the version when the layout changes.
+# Version 1 had a padding byte where the codec is, so it's read as a raw body.
+CACHE_MAGIC = b"UQCF"
+CACHE_VERSION = 2
+CACHE_HEADER = struct.Struct(">4sBBBBHHII")  # magic, format, version, strict, codec, status, reason, headers, body
+
+# Codecs that the body can be stored with in the cache
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+
+#: The zlib compression level, used to compress the body of responses that did not arrive compressed.
+#: 0 will store the body as it arrived.
+CACHE_COMPRESS_LEVEL = 1
+
+#: Number of times a cache file is loaded, before it's considered hot. Hot cache files are stored
+#: decompressed, trading disk space for faster loads. 0 will always store the body compressed.
+CACHE_HOT_HITS = 5
+
+#: Max total size in bytes, of the response bodies kept in the in-memory cache. 0 will disable the memory cache.
+MEMORY_CACHE_SIZE = 4194304  # 4 MB
+
+#: Max total size in bytes, of the on-disk cache. 0 will disable size based eviction.
+MAX_CACHE_SIZE = 104857600  # 100 MB
+
+#: The policy used to select which cache files to evict, when the cache goes over
+#: :data:`MAX_CACHE_SIZE <urlquick.MAX_CACHE_SIZE>`. "lru" (least recently used) or "lfu" (least frequently used).
+CACHE_EVICTION_POLICY = u"lru"
+
+#: Max number of connections, in use or idle, that will be kept open to a single host.
+MAX_CONNECTIONS = 4
+
+#: Seconds that a persistent connection can be idle, before it's closed instead of reused.
+CONNECTION_IDLE_TIMEOUT = 60
+
 # Unique logger for this module
 logger = logging.getLogger("urlquick")
 
@@ -252,38 +310,518 @@ class CachedProperty(object):
         instance.__dict__.pop(self.__name__, None)
 
 
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into a dict of directives.
+
+    :param value: The Cache-Control header value.
+    :returns: Dict of lowercase directive names to there argument, or None if the directive has no argument.
+    """
+    directives = {}
+    for directive in value.split(u","):
+        name, _, arg = directive.partition(u"=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip(u'"') or None
+    return directives
+
+
+def parse_http_date(value):
+    """Return a HTTP date as a unix timestamp, or None if the date is invalid."""
+    try:
+        parsed = parsedate_tz(value)
+        return mktime_tz(parsed) if parsed else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def replace_file(src, dst):
+    """Atomically replace dst with src, where the platform allows."""
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # Python 2 on windows will not rename over an existing file
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def make_dirs(path):
+    """Create the directory if missing, another process may be creating it at the same time."""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def temp_path(path):
+    """Return a temporary path to write to, that is unique to the process and thread, before renaming into place."""
+    suffix = u".{}-{}.tmp".format(os.getpid(), threading.current_thread().ident)
+    return path + (suffix.encode("ascii") if isinstance(path, bytes) else suffix)
+
+
+class CacheLock(object):
+    """
+    Reader/writer lock of the cache, shared between all processes using the cache.
+
+    Uses :func:`fcntl.flock` where available, else the lock only works within the process.
+    The lock is reentrant within the process, but an exclusive lock must not be taken within a shared lock.
+
+    :param path: Path to the lock file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._stream = None
+        self._depth = 0
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        """Hold the lock, exclusive for writers or shared for readers."""
+        with self._thread_lock:
+            if self._depth == 0 and fcntl is not None:
+                self._flock(fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and fcntl is not None:
+                    self._flock(fcntl.LOCK_UN)
+
+    def _flock(self, operation):
+        try:
+            if self._stream is None:
+                self._stream = open(self.path, "ab")
+            fcntl.flock(self._stream.fileno(), operation)
+        except (IOError, OSError):
+            logger.exception("Cache Error: Failed to lock cache.")
+
+
+class CacheRecord(namedtuple("CacheRecord", "mtime size status atime hits flags")):
+    """
+    Index record of a cache file.
+
+    :ivar float mtime: Time the response was stored or last revalidated, used to check freshness.
+    :ivar int size: Size of the cache file in bytes.
+    :ivar int status: Status code of the cached response.
+    :ivar float atime: Time the cache file was last accessed.
+    :ivar int hits: Number of times the cache file was accessed.
+    :ivar int flags: Bit flags, see :data:`CacheRecord.PROTECTED`.
+    """
+    __slots__ = ()
+
+    #: Flag for entries that should only be evicted as a last resort.
+    PROTECTED = 1
+
+    @property
+    def protected(self):
+        """True if the entry is a permanent redirect, or was stored with a max_age of -1."""
+        return bool(self.flags & self.PROTECTED) or self.status in (301, 308)
+
+
+class MemoryCache(object):
+    """
+    In-process LRU cache of responses, layered in front of the on-disk cache.
+
+    Entries are evicted, least recently used first, when the total size
+    of the cached bodies goes over the given limit. Safe to share between threads.
+
+    :param int max_size: Max total size in bytes of all cached bodies.
+    """
+
+    def __init__(self, max_size):
+        self._lock = threading.RLock()
+        self._store = OrderedDict()
+        self.max_size = max_size
+        self.size = 0
+
+    def get(self, uid):
+        """Return a tuple of (response, timestamp) or None if not cached."""
+        with self._lock:
+            try:
+                entry = self._store.pop(uid)
+            except KeyError:
+                return None
+            else:
+                # Re-insert to mark as the most recently used
+                self._store[uid] = entry
+                return entry
+
+    def put(self, uid, response, timestamp):
+        """Add a response to the cache, evicting old entries if required."""
+        with self._lock:
+            self.pop(uid)
+            body_size = len(response.body)
+            if not self.max_size or body_size > self.max_size:
+                return None
+
+            self._store[uid] = (response, timestamp)
+            self.size += body_size
+            while self.size > self.max_size:
+                _, (old, _) = self._store.popitem(last=False)
+                self.size -= len(old.body)
+
+    def touch(self, uid, timestamp):
+        """Update the timestamp of a cached response."""
+        with self._lock:
+            if uid in self._store:
+                self._store[uid] = (self._store[uid][0], timestamp)
+
+    def pop(self, uid):
+        """Remove a response from the cache."""
+        with self._lock:
+            entry = self._store.pop(uid, None)
+            if entry:
+                self.size -= len(entry[0].body)
+
+    def clear(self):
+        """Remove all responses from the cache."""
+        with self._lock:
+            self._store.clear()
+            self.size = 0
+
+
+class CacheIndex(object):
+    """
+    Index of all the cache files, so that the cache directory never needs to be walked.
+
+    The index is stored as an append only log of :class:`CacheRecord` records, one per line.
+    A record with a size of -1 marks the removal of a cache file. The log is compacted once it
+    holds a lot more records than there are cache files.
+
+    Accesses of cache files are only kept in memory, until written out together by :meth:`flush`.
+    So reading from the cache never has to write to the index.
+
+    The index is shared between processes. Records appended by other processes are replayed
+    before the index is used, and the whole log is reloaded if it was compacted by another process.
+
+    :param cache_dir: The cache directory, the index will be stored within.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, CacheHandler.safe_path(u"index"))
+        self.lock = CacheLock(os.path.join(cache_dir, CacheHandler.safe_path(u"lock")))
+        self.entries = {}
+        self.size = 0
+        self._records = 0
+        self._offset = 0
+        self._file_id = None
+        self._accessed = {}  # key -> (last access time, number of accesses) not yet written to the log
+
+        with self.lock.locked():
+            if os.path.exists(self.path):
+                self.refresh()
+            else:
+                self.rebuild()
+
+    @staticmethod
+    def _key(uid):
+        """Return the uid as a text key."""
+        return uid.decode("ascii") if isinstance(uid, bytes) else uid
+
+    def refresh(self):
+        """Replay any records written to the index log since it was last read, by this or any other process."""
+        with self.lock.locked(exclusive=False):
+            try:
+                stat = os.stat(self.path)
+            except EnvironmentError:
+                return None
+
+            # The log was replaced by another process, so it needs to be reloaded from the start
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._file_id or stat.st_size < self._offset:
+                self.entries.clear()
+                self.size = 0
+                self._records = 0
+                self._offset = 0
+                self._file_id = file_id
+
+            if stat.st_size > self._offset:
+                self._load()
+
+    def _load(self):
+        """Replay the index log, from where it was last read."""
+        try:
+            with open(self.path, "rb") as stream:
+                stream.seek(self._offset)
+                data = stream.read()
+        except (IOError, OSError):
+            logger.exception("Cache Error: Failed to read cache index.")
+            return None
+
+        # Leave any partially written record, to be read once complete
+        data = data[:data.rfind(b"\n") + 1]
+        self._offset += len(data)
+
+        # A trailing empty string is left after the last record, which is skipped over as corrupt
+        for line in data.decode("ascii").split(u"\n"):
+            try:
+                key, mtime, size, status, atime, hits, flags = line.split(u" ")
+                record = CacheRecord(float(mtime), int(size), int(status), float(atime), int(hits), int(flags))
+            except ValueError:
+                # Skip over any corrupt record
+                continue
+
+            self._records += 1
+            self._set(key, None if record.size < 0 else record)
+
+    def _set(self, key, record):
+        """Update the in memory entries, keeping track of the total cache size."""
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        if record is not None:
+            self.entries[key] = record
+            self.size += record.size
+
+    @staticmethod
+    def _serialize(records):
+        return u"".join(u"{} {:.2f} {} {} {:.2f} {} {}\n".format(key, *record) for key, record in records)
+
+    def _append(self, records):
+        """Append records to the index log, the exclusive lock must be held."""
+        data = self._serialize(records).encode("ascii")
+        try:
+            with open(self.path, "ab") as stream:
+                stream.write(data)
+        except (IOError, OSError):
+            logger.exception("Cache Error: Failed to update cache index.")
+        else:
+            self._offset += len(data)
+
+    def _rewrite(self):
+        """Atomically replace the index log with the current entries, the exclusive lock must be held."""
+        data = self._serialize(self.entries.items()).encode("ascii")
+        tmp_path = temp_path(self.path)
+        try:
+            with open(tmp_path, "wb") as stream:
+                stream.write(data)
+            replace_file(tmp_path, self.path)
+            stat = os.stat(self.path)
+        except (IOError, OSError):
+            logger.exception("Cache Error: Failed to update cache index.")
+        else:
+            self._records = len(self.entries)
+            self._offset = len(data)
+            self._file_id = (stat.st_dev, stat.st_ino)
+
+    def get(self, uid):
+        """Return the :class:`CacheRecord` for the given uid, or None if not cached."""
+        self.refresh()
+        return self.entries.get(self._key(uid))
+
+    def items(self):
+        """Return a list of (uid, record) for all the cache files."""
+        with self.lock.locked(exclusive=False):
+            self.refresh()
+            return list(self.entries.items())
+
+    def add(self, uid, mtime, size, status, flags=0, hits=0):
+        """Add or update the record of a cache file."""
+        key = self._key(uid)
+        record = self._accessed_record(key, CacheRecord(mtime, size, status, time.time(), hits, flags))
+        self._update(key, record)
+
+    def hits(self, uid):
+        """Return the number of times the cache file has been accessed, including accesses not yet written."""
+        record = self.get(uid)
+        return (record.hits if record else 0) + self._accessed.get(self._key(uid), (0, 0))[1]
+
+    def touch(self, uid, mtime=None):
+        """
+        Record an access of a cache file, optionally updating its modified time.
+
+        The access is only written to the log by :meth:`flush`, unless the modified time changed.
+
+        :returns: The number of times the cache file has been accessed.
+        """
+        key = self._key(uid)
+        accessed = self._accessed.get(key, (0, 0))[1] + 1
+        self._accessed[key] = (time.time(), accessed)
+        if mtime is not None:
+            with self.lock.locked():
+                self.refresh()
+                record = self.entries.get(key)
+                if record is not None:
+                    self._update(key, self._accessed_record(key, record)._replace(mtime=mtime))
+
+        record = self.entries.get(key)
+        return record.hits + self._accessed.get(key, (0, 0))[1] if record else accessed
+
+    def _accessed_record(self, key, record):
+        """Return the record with any accesses, that have not been written yet, applied."""
+        atime, hits = self._accessed.pop(key, (0, 0))
+        return record._replace(atime=max(atime, record.atime), hits=record.hits + hits) if hits else record
+
+    def flush(self):
+        """Write all recorded accesses of cache files to the log, in one go."""
+        if self._accessed:
+            with self.lock.locked():
+                self.refresh()
+                records = [(key, self._accessed_record(key, self.entries[key]))
+                           for key in list(self._accessed) if key in self.entries]
+                self._accessed.clear()
+                for key, record in records:
+                    self._set(key, record)
+                self._records += len(records)
+                self._append(records)
+
+    def _update(self, key, record):
+        with self.lock.locked():
+            self.refresh()
+            self._set(key, record)
+            self._records += 1
+            self._append([(key, record)])
+
+    def remove(self, uid):
+        """Remove the record of a cache file."""
+        key = self._key(uid)
+        with self.lock.locked():
+            self.refresh()
+            if key in self.entries:
+                self._set(key, None)
+                self._records += 1
+                self._append([(key, CacheRecord(0, -1, 0, 0, 0, 0))])
+
+    def compact(self):
+        """Rewrite the index log, if it contains a lot of outdated records."""
+        with self.lock.locked():
+            self.refresh()
+            if self._records > len(self.entries) * 2 + 100:
+                self._rewrite()
+
+    def eviction_candidates(self, policy=u"lru"):
+        """
+        Return the list of uids, in the order that they should be evicted.
+
+        Protected entries, permanent redirects and entries that never expire,
+        are always ordered after all other entries.
+
+        :param str policy: "lru" to evict the least recently used first, or "lfu" for the least frequently used.
+        """
+        if policy == u"lfu":
+            def sort_key(item):
+                return item[1].protected, item[1].hits, item[1].atime
+        else:
+            def sort_key(item):
+                return item[1].protected, item[1].atime
+
+        return [key for key, _ in sorted(self.items(), key=sort_key)]
+
+    def rebuild(self):
+        """Rebuild the index from the cache files on disk, moving any unsharded files to there shard."""
+        logger.debug("Building cache index")
+        cache_dir = self.cache_dir
+        filestart = CacheHandler.safe_path(u"cache-")
+        tempmark = CacheHandler.safe_path(u".")
+
+        with self.lock.locked():
+            self.entries.clear()
+            self.size = 0
+
+            for name in os.listdir(cache_dir):
+                path = os.path.join(cache_dir, name)
+                if name.startswith(filestart):
+                    # Cache file from before the cache was sharded
+                    shard_path = CacheHandler.cache_path(name)
+                    try:
+                        os.renames(path, shard_path)
+                    except EnvironmentError:
+                        continue
+                    files = [(name, shard_path)]
+                elif os.path.isdir(path):
+                    # Temporary files, from writes that never completed, are not cache files
+                    files = [(sub, os.path.join(path, sub)) for sub in os.listdir(path)
+                             if sub.startswith(filestart) and tempmark not in sub]
+                else:
+                    continue
+
+                for uid, file_path in files:
+                    try:
+                        stat = os.stat(file_path)
+                    except EnvironmentError:
+                        continue
+                    self._set(self._key(uid), CacheRecord(stat.st_mtime, stat.st_size, 0, stat.st_mtime, 0, 0))
+
+            self._rewrite()
+
+
 class CacheHandler(object):
     # Checks if it's time to initiate a cache cleanup
     initiate_cleanup = _addon_data.getSetting("cache_cleanup_timestamp") == "" or \
                        (time.time() - float(_addon_data.getSetting("cache_cleanup_timestamp")) > 60 * 60 * 24 * 28)
 
-    def __init__(self, uid, max_age=MAX_AGE):
+    # In memory cache of responses, shared between all handlers
+    memory = MemoryCache(MEMORY_CACHE_SIZE)
+    _index_lock = threading.Lock()
+    _cache_index = None
+    _cache_dir = None
+
+    def __init__(self, uid, max_age=MAX_AGE, override=False, request_headers=None):
+        self.request_headers = request_headers if request_headers is not None else {}
+        self.override = override
         self.max_age = max_age
         self.response = None
-
-        if self.initiate_cleanup:
-            cache_cleanup(60 * 60 * 24 * 14)
-            _addon_data.setSetting("cache_cleanup_timestamp", str(time.time()))
+        self.timestamp = None
+        self.codec = None
+        self.uid = uid
 
         # Filepath to cache file
-        cache_dir = self.cache_dir()
-        self.cache_file = cache_file = os.path.join(cache_dir, uid)
-        if os.path.exists(cache_file):
-            self.response = self._load()
-            if self.response is None:
-                self.delete(cache_file)
+        self.cache_file = cache_file = self.cache_path(uid)
+
+        # Check the memory cache first, then the index, to save hitting the filesystem
+        entry = self.memory.get(uid)
+        if entry:
+            self.response, self.timestamp = entry
+        else:
+            index = self.cache_index()
+            record = index.get(uid)
+            if record:
+                self.timestamp = record.mtime
+                self.response = self._load()
+                if self.response is None:
+                    self.delete(cache_file)
+                else:
+                    hits = index.touch(uid)
+                    if CACHE_HOT_HITS and hits >= CACHE_HOT_HITS and self._compressed():
+                        self._promote()
+                    self.memory.put(uid, self.response, self.timestamp)
 
     @classmethod
     def cache_dir(cls):
         """Returns the cache directory."""
-        cache_dir = cls.safe_path(os.path.join(CACHE_LOCATION, u".cache"))
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        return cache_dir
+        if cls._cache_dir is None:
+            cache_dir = cls.safe_path(os.path.join(CACHE_LOCATION, u".cache"))
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            CacheHandler._cache_dir = cache_dir
+        return cls._cache_dir
 
-    @staticmethod
-    def delete(cache_path):
+    @classmethod
+    def cache_index(cls):
+        """Returns the index of all cache files."""
+        if cls._cache_index is None:
+            with cls._index_lock:
+                if cls._cache_index is None:
+                    CacheHandler._cache_index = CacheIndex(cls.cache_dir())
+        return cls._cache_index
+
+    @classmethod
+    def cache_path(cls, uid):
+        """Returns the path to the cache file, sharded into subdirectories by the first two characters of the hash."""
+        return os.path.join(cls.cache_dir(), uid[6:8], uid)
+
+    @classmethod
+    def delete(cls, cache_path):
         """Delete cache from disk."""
+        uid = os.path.basename(cache_path)
+        cls.memory.pop(uid)
+        cls.cache_index().remove(uid)
         try:
             os.remove(cache_path)
         except EnvironmentError:
@@ -291,23 +829,137 @@ class CacheHandler(object):
         else:
             logger.debug("Removed cache: %s", cache_path)
 
-    @staticmethod
-    def isfilefresh(cache_path, max_age):
-        return (time.time() - os.stat(cache_path).st_mtime) < max_age
+    def cache_control(self):
+        """Return the Cache-Control directives of the cached response."""
+        return parse_cache_control(self.response.headers.get(u"Cache-Control", u""))
+
+    def freshness_lifetime(self):
+        """
+        Return the number of seconds that the cached response is fresh for, or None if it never goes stale.
+
+        The server's Cache-Control and Expires headers are used, falling back to the max age when
+        the server gives neither. An explicit max age given by the caller overrides the server.
+        """
+        if not self.override:
+            directives = self.cache_control()
+            if u"no-cache" in directives:
+                return 0
+            elif u"max-age" in directives:
+                try:
+                    return max(int(directives[u"max-age"]), 0)
+                except (TypeError, ValueError):
+                    return 0
+
+            headers = self.response.headers
+            if u"Expires" in headers:
+                # An invalid expires date, e.g. "0", means already expired
+                expires = parse_http_date(headers[u"Expires"])
+                date = parse_http_date(headers.get(u"Date", u"")) or self.timestamp
+                return max(expires - date, 0) if expires else 0
+
+            # Permanent responses are fresh forever unless the server says otherwise
+            if self.response.status in (301, 308, 414):
+                return None
+
+        return None if self.max_age == -1 else self.max_age
+
+    def age(self):
+        """Return the age of the cached response in seconds, including the time it spent in upstream caches."""
+        age = time.time() - self.timestamp
+        if not self.override:
+            try:
+                age += max(int(self.response.headers.get(u"Age", 0)), 0)
+            except ValueError:
+                pass
+        return age
 
     def isfresh(self):
         """Return True if cache is fresh else False."""
-        # Check that the response is of status 301 or that the cache is not older than the max age
-        if self.response.status in (301, 308, 414) or self.max_age == -1:
+        lifetime = self.freshness_lifetime()
+        return lifetime is None or self.age() < lifetime
+
+    def usable_stale(self, window):
+        """
+        Return True if the stale cache can still be used.
+
+        Stale cache is never used if the server requires it to be revalidated, unless the caller overrode the max age.
+
+        :param window: Seconds past the max age that the cache can be used, or ``True`` for no limit.
+        """
+        if not window:
+            return False
+
+        if not self.override:
+            directives = self.cache_control()
+            if u"must-revalidate" in directives or u"no-cache" in directives:
+                return False
+
+        if window is True:
             return True
-        elif self.max_age == 0:
+        else:
+            return (self.age() - (self.freshness_lifetime() or 0)) <= window
+
+    def storable(self, headers):
+        """Return True if a response with the given headers can be stored in the cache."""
+        if self.vary(headers) is None:
             return False
+        elif self.override:
+            return True
+        else:
+            cache_control = CaseInsensitiveDict(headers).get(u"Cache-Control", u"")
+            return u"no-store" not in parse_cache_control(cache_control)
+
+    def vary(self, headers):
+        """
+        Return the values of the request headers that the response varies on, or None if the response
+        varies on everything, and can't be cached.
+        """
+        vary = {}
+        value = CaseInsensitiveDict(headers).get(u"Vary", u"")
+        request_headers = CaseInsensitiveDict(self.request_headers)
+        for name in value.split(u","):
+            name = name.strip().lower()
+            if name == u"*":
+                return None
+            elif name:
+                vary[name] = request_headers.get(name, u"")
+        return vary
+
+    def matches(self, request_headers):
+        """Return True if the cached response was stored for the same values of the vary headers."""
+        request_headers = CaseInsensitiveDict(request_headers)
+        return all(request_headers.get(name, u"") == value for name, value in self.response.vary.items())
+
+    def revalidated(self, headers):
+        """
+        Update the cache after the server confirmed it's still valid.
+
+        The cache file is only rewritten if the server sent new freshness headers, else just the timestamp is reset.
+
+        :param headers: The headers of the 304 Not Modified response.
+        """
+        headers = CaseInsensitiveDict(headers)
+        response = self.response
+        cached = response.headers
+        if any(key in headers and headers[key] != cached.get(key) for key in FRESHNESS_HEADERS):
+            merged = CaseInsensitiveDict(cached)
+            for key in FRESHNESS_HEADERS + (u"Date",):
+                if key in headers:
+                    merged[key] = headers[key]
+            self.update(merged, response.body, response.status, response.reason, response.version, response.strict)
         else:
-            return self.isfilefresh(self.cache_file, self.max_age)
+            self.reset_timestamp()
 
     def reset_timestamp(self):
         """Reset the last modified timestamp to current time."""
-        os.utime(self.cache_file, None)
+        try:
+            os.utime(self.cache_file, None)
+        except EnvironmentError:
+            # The cache file was removed by another process, the index will be updated anyway
+            pass
+        self.timestamp = timestamp = time.time()
+        self.memory.touch(self.uid, timestamp)
+        self.cache_index().touch(self.uid, timestamp)
 
     def add_conditional_headers(self, headers):
         """Return a dict of conditional headers from cache."""
@@ -336,48 +988,206 @@ class CacheHandler(object):
         reason = unicode(reason)
 
         # Create response data structure
-        self.response = CacheResponse(headers, body, status, reason, version, strict)
+        vary = self.vary(headers) or {}
+        self.response = response = CacheResponse(headers, body, status, reason, version, strict, vary)
+        self.timestamp = time.time()
 
         # Save response to disk
-        self._save(headers=dict(headers), body=body, status=status, reason=reason, version=version, strict=strict)
+        headers = self._stored_headers(headers, vary)
+        if self._save(headers=headers, body=body, status=status, reason=reason, version=version, strict=strict):
+            self.memory.put(self.uid, response, self.timestamp)
+
+    @staticmethod
+    def _stored_headers(headers, vary):
+        """Return the headers to store, the vary values are stored as pseudo headers starting with ':'."""
+        headers = dict(headers)
+        for name, value in vary.items():
+            headers[u":" + name] = value
+        return headers
 
     def _load(self):
         """Load the cache response that is stored on disk."""
         try:
-            # Atempt to read the raw cache data
-            with _open(self.cache_file, "rb", encoding="utf8") as stream:
-                json_data = _json.load(stream)
+            # Read the whole cache file in one go, the header tells us where everything is
+            with open(self.cache_file, "rb") as stream:
+                data = stream.read()
 
         except (IOError, OSError):
             logger.exception("Cache Error: Failed to read cached response.")
             return None
 
-        except TypeError:
+        # Cache files from older versions of urlquick are stored as json
+        if data[:1] == b"{":
+            return self._migrate(data)
+
+        try:
+            response, self.codec = self._decode(data)
+        except (ValueError, struct.error, zlib.error):
             logger.exception("Cache Error: Failed to deserialize cached response.")
             return None
+        else:
+            return response
+
+    def _compressed(self):
+        """Return True if the body of the cache file is stored compressed."""
+        encoding = self.response.headers.get(u"content-encoding", u"").lower()
+        return self.codec == CODEC_ZLIB or u"gzip" in encoding or u"deflate" in encoding
+
+    def _promote(self):
+        """Store a decompressed copy of a hot cache file, keeping the original age of the cache."""
+        response = self.response
+        headers, body, _ = self._compress(response.headers, response.body, hot=True)
+        if self._save(headers=self._stored_headers(headers, response.vary), body=body, status=response.status,
+                      reason=response.reason, version=response.version, strict=response.strict):
+            logger.debug("Storing decompressed copy of hot cache: %s", self.cache_file)
+            os.utime(self.cache_file, (self.timestamp, self.timestamp))
+            self.response = CacheResponse(CaseInsensitiveDict(headers), body, response.status, response.reason,
+                                          response.version, response.strict, response.vary)
+
+    @staticmethod
+    def _compress(headers, body, hot=False):
+        """
+        Return the (headers, body, codec) to store in the cache.
 
-        # Decode body content using base64
-        json_data[u"body"] = b64decode(json_data[u"body"].encode("ascii"))
-        json_data[u"headers"] = CaseInsensitiveDict(json_data[u"headers"])
-        return CacheResponse(**json_data)
+        A body that arrived compressed is kept in its wire form, anything else is compressed with zlib.
+        Hot cache files are stored fully decompressed, so they load without any decompression.
+        """
+        encoding = CaseInsensitiveDict(headers).get(u"content-encoding", u"").lower()
+        if hot:
+            try:
+                if u"gzip" in encoding:
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                elif u"deflate" in encoding:
+                    body = zlib.decompress(body)
+                else:
+                    return headers, body, CODEC_RAW
+            except zlib.error:
+                return headers, body, CODEC_RAW
+
+            # The body is no longer encoded
+            skip = (u"content-encoding", u"content-length")
+            headers = {key: value for key, value in headers.items() if key.lower() not in skip}
+            return headers, body, CODEC_RAW
+
+        elif not encoding and CACHE_COMPRESS_LEVEL:
+            return headers, zlib.compress(body, CACHE_COMPRESS_LEVEL), CODEC_ZLIB
+        else:
+            return headers, body, CODEC_RAW
+
+    def _migrate(self, data):
+        """Convert a legacy json cache file into the binary cache format."""
+        try:
+            json_data = _json.loads(data.decode("utf8"))
+            body = b64decode(json_data[u"body"].encode("ascii"))
+            headers = CaseInsensitiveDict(json_data[u"headers"])
+            response = CacheResponse(headers, body, json_data[u"status"], json_data[u"reason"],
+                                     json_data.get(u"version", 11), json_data.get(u"strict", True))
+        except (ValueError, TypeError, KeyError):
+            logger.exception("Cache Error: Failed to deserialize cached response.")
+            return None
+
+        # Save in the new format, but keep the original timestamp so the age of the cache is unchanged
+        logger.debug("Migrating json cache file to binary format: %s", self.cache_file)
+        self.codec = None
+        if self._save(headers=dict(headers), body=body, status=response.status, reason=response.reason,
+                      version=response.version, strict=response.strict):
+            os.utime(self.cache_file, (self.timestamp, self.timestamp))
+        return response
+
+    @staticmethod
+    def _decode(data):
+        """Deserialize a binary cache file, returning a tuple of (CacheResponse, codec)."""
+        magic, fmt, version, strict, codec, status, reason_len, headers_len, body_len = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or fmt not in (1, CACHE_VERSION):
+            raise ValueError("unsupported cache format: {!r} v{}".format(magic, fmt))
+
+        # Calculate the offset of each section
+        reason_start = CACHE_HEADER.size
+        headers_start = reason_start + reason_len
+        body_start = headers_start + headers_len
+        if len(data) != body_start + body_len:
+            raise ValueError("cache file is truncated")
+
+        reason = data[reason_start:headers_start].decode("utf8")
+        headers = CaseInsensitiveDict()
+        vary = {}
+        # Split on the record separator only, header values may contain other line break characters
+        for line in data[headers_start:body_start].decode("utf8").split(u"\n") if headers_len else ():
+            key, value = line.split(u": ", 1)
+            if key.startswith(u":"):
+                vary[key[1:]] = value
+            else:
+                headers[key] = value
+
+        body = data[body_start:]
+        if codec == CODEC_ZLIB:
+            body = zlib.decompress(body)
+        elif codec != CODEC_RAW:
+            raise ValueError("unsupported cache codec: {}".format(codec))
+
+        return CacheResponse(headers, body, status, reason, version, bool(strict), vary), codec
+
+    @staticmethod
+    def _encode(headers, body, status, reason, version=11, strict=True, codec=CODEC_RAW):
+        """Serialize a response into the binary cache format."""
+        return CacheHandler._encode_meta(headers, status, reason, version, strict, codec, len(body)) + body
+
+    @staticmethod
+    def _encode_meta(headers, status, reason, version, strict, codec, body_len):
+        """Serialize everything that comes before the body in the binary cache format."""
+        reason = reason.encode("utf8")
+        headers = u"\n".join(u"{}: {}".format(key, value) for key, value in headers.items()).encode("utf8")
+        header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, version, bool(strict), codec, status,
+                                   len(reason), len(headers), body_len)
+        return b"".join((header, reason, headers))
+
+    def writer(self, headers, status, reason, version=11, strict=True):
+        """Return a :class:`CacheWriter`, to write a streamed response through to this cache."""
+        return CacheWriter(self, headers, status, reason, version, strict)
+
+    @classmethod
+    def from_url(cls, url, data=None, max_age=MAX_AGE, override=False, request_headers=None):
+        """Initialize CacheHandler with url instead of uid."""
+        uid = cls.hash_url(url, data)
+        return cls(uid, max_age, override, request_headers)
 
     def _save(self, **response):
-        # Base64 encode the body to make it json serializable
-        response[u"body"] = b64encode(response["body"]).decode("ascii")
+        # Keep the hit count of the cache file, so that hot cache files stay hot when refreshed
+        index = self.cache_index()
+        record = index.get(self.uid)
+        hits = record.hits if record else 0
 
+        tmp_path = temp_path(self.cache_file)
         try:
-            # Save the response to disk using json Serialization
-            with _open(self.cache_file, "wb", encoding="utf8") as stream:
-                _json.dump(response, stream, indent=4, separators=(",", ":"))
+            hot = 0 < CACHE_HOT_HITS <= index.hits(self.uid)
+            response["headers"], response["body"], codec = self._compress(response["headers"], response["body"], hot)
+            data = self._encode(codec=codec, **response)
+
+            # Create the shard directory if missing
+            make_dirs(os.path.dirname(self.cache_file))
+
+            # Save the response to disk using the binary cache format, readers in other
+            # processes will see either the old or the new cache file, never a partial one
+            with open(tmp_path, "wb") as stream:
+                stream.write(data)
+            replace_file(tmp_path, self.cache_file)
 
         except (IOError, OSError):
             logger.exception("Cache Error: Failed to write response to cache.")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             self.delete(self.cache_file)
 
-        except TypeError:
+        except (TypeError, struct.error):
             logger.exception("Cache Error: Failed to serialize response.")
             self.delete(self.cache_file)
 
+        else:
+            flags = CacheRecord.PROTECTED if self.max_age == -1 else 0
+            index.add(self.uid, self.timestamp, len(data), response["status"], flags, hits)
+            return True
+        return False
+
     @staticmethod
     def safe_path(path):
         """
@@ -414,12 +1224,6 @@ class CacheHandler(object):
         # Append urlhash to the filename
         return cls.safe_path(u"cache-{}".format(urlhash))
 
-    @classmethod
-    def from_url(cls, url, data=None, max_age=MAX_AGE):
-        """Initialize CacheHandler with url instead of uid."""
-        uid = cls.hash_url(url, data)
-        return cls(uid, max_age)
-
     def __bool__(self):
         return self.response is not None
 
@@ -427,154 +1231,703 @@ class CacheHandler(object):
         return self.response is not None
 
 
-def cache_cleanup(max_age=None):
+class CacheWriter(object):
+    """
+    Writes the body of a streamed response through to the cache, as the body is read.
+
+    The response is written to a temporary file, which replaces the cache file
+    once the body is complete. The body length in the header is filled in last.
+
+    :param CacheHandler cache: The cache handler of the request.
+    """
+
+    def __init__(self, cache, headers, status, reason, version=11, strict=True):
+        # Convert headers into a Case Insensitive Dict
+        headers = CaseInsensitiveDict(headers)
+
+        # Remove Transfer-Encoding from header if exists
+        if u"Transfer-Encoding" in headers:
+            del headers[u"Transfer-Encoding"]
+
+        # Compress the body on the fly, if it did not arrive compressed
+        if u"Content-Encoding" not in headers and CACHE_COMPRESS_LEVEL:
+            self._compressor = zlib.compressobj(CACHE_COMPRESS_LEVEL)
+            codec = CODEC_ZLIB
+        else:
+            self._compressor = None
+            codec = CODEC_RAW
+
+        # noinspection PyArgumentList
+        self.meta = (cache._stored_headers(headers, cache.vary(headers) or {}), status, unicode(reason),
+                     version, strict, codec)
+        self.path = temp_path(cache.cache_file)
+        self.cache = cache
+        self.size = 0
+
+        try:
+            # Create the shard directory if missing
+            make_dirs(os.path.dirname(self.path))
+
+            # The header is written again once the body length is known
+            self._stream = open(self.path, "wb")
+            self._stream.write(CacheHandler._encode_meta(*self.meta, body_len=0))
+        except (IOError, OSError):
+            logger.exception("Cache Error: Failed to write response to cache.")
+            self._stream = None
+
+    def write(self, data):
+        """Append a chunk of the body to the cache."""
+        if self._stream is not None:
+            try:
+                if self._compressor is not None:
+                    data = self._compressor.compress(data)
+                self._stream.write(data)
+                self.size += len(data)
+            except (IOError, OSError):
+                logger.exception("Cache Error: Failed to write response to cache.")
+                self.abort()
+
+    def commit(self):
+        """Complete the cache file, once the full body has been written."""
+        stream, self._stream = self._stream, None
+        if stream is None:
+            return None
+
+        cache = self.cache
+        try:
+            if self._compressor is not None:
+                data = self._compressor.flush()
+                stream.write(data)
+                self.size += len(data)
+
+            meta = CacheHandler._encode_meta(*self.meta, body_len=self.size)
+            stream.seek(0)
+            stream.write(meta)
+            stream.close()
+            replace_file(self.path, cache.cache_file)
+
+        except (IOError, OSError, struct.error):
+            logger.exception("Cache Error: Failed to write response to cache.")
+            self._remove()
+            cache.delete(cache.cache_file)
+
+        else:
+            # The body is never kept in memory, so drop any stale copy from the memory cache
+            cache.timestamp = time.time()
+            cache.memory.pop(cache.uid)
+            index = cache.cache_index()
+            record = index.get(cache.uid)
+            flags = CacheRecord.PROTECTED if cache.max_age == -1 else 0
+            index.add(cache.uid, cache.timestamp, len(meta) + self.size, self.meta[1], flags,
+                      record.hits if record else 0)
+
+    def abort(self):
+        """Discard the partially written response."""
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.close()
+            self._remove()
+
+    def _remove(self):
+        try:
+            os.remove(self.path)
+        except EnvironmentError:
+            pass
+
+
+def cache_cleanup(max_age=None, deadline=None):
     """
     Remove all stale cache files.
 
     :param int max_age: [opt] The max age the cache can be before removal.
                         defaults => :data:`MAX_AGE <urlquick.MAX_AGE>`
+    :param float deadline: [opt] Time, as returned by :func:`time.time`, after which to stop removing files.
+
+    :returns: True if all stale cache files were removed, else False if the deadline was reached first.
     """
     handler = CacheHandler
     max_age = MAX_AGE if max_age is None else max_age
-    cache_dir = handler.cache_dir()
-
-    # Loop over all cache files and remove stale files
-    filestart = handler.safe_path(u"cache-")
-    for cachefile in os.listdir(cache_dir):
-        # Check that we actually have a cache file
-        if cachefile.startswith(filestart):
-            cache_path = os.path.join(cache_dir, cachefile)
-            # Check if the cache is not fresh and delete if so
-            if not handler.isfilefresh(cache_path, max_age):
-                handler.delete(cache_path)
+    index = handler.cache_index()
+    expired = time.time() - max_age
+
+    # Scan the index for stale cache files and remove them
+    for uid, record in index.items():
+        if deadline and time.time() > deadline:
+            index.compact()
+            return False
+        elif record.mtime < expired:
+            handler.delete(handler.cache_path(handler.safe_path(uid)))
+
+    index.compact()
 
     # Disable cleanup flag
     handler.initiate_cleanup = False
+    return True
 
 
-class CacheAdapter(object):
+def cache_evict(max_size=None, policy=None, deadline=None):
+    """
+    Evict cache files until the total size of the cache is within the given size.
+
+    The cache is evicted down to 90% of the max size, so that eviction does not run on every write.
+    Permanent redirects and entries that never expire, are only evicted once all other entries are gone.
+
+    :param int max_size: [opt] The max size in bytes the cache can be.
+                         defaults => :data:`MAX_CACHE_SIZE <urlquick.MAX_CACHE_SIZE>`
+    :param str policy: [opt] The eviction policy to use, "lru" or "lfu".
+                       defaults => :data:`CACHE_EVICTION_POLICY <urlquick.CACHE_EVICTION_POLICY>`
+    :param float deadline: [opt] Time, as returned by :func:`time.time`, after which to stop evicting files.
+
+    :returns: True if the cache is within the max size, else False if the deadline was reached first.
+    """
+    handler = CacheHandler
+    index = handler.cache_index()
+    max_size = MAX_CACHE_SIZE if max_size is None else max_size
+    target = max_size * 0.9
+    if index.size <= max_size:
+        return True
+
+    logger.debug("Cache size %d is over the limit of %d, evicting cache files", index.size, max_size)
+    index.flush()
+    for uid in index.eviction_candidates(policy or CACHE_EVICTION_POLICY):
+        if index.size <= target:
+            break
+        elif deadline and time.time() > deadline:
+            index.compact()
+            return False
+        else:
+            handler.delete(handler.cache_path(handler.safe_path(uid)))
+
+    index.compact()
+    return True
+
+
+def cache_maintenance(deadline=None):
+    """
+    Run any pending cache housekeeping.
+
+    Accesses of cache files are written to the cache index, and the index is compacted if it has grown
+    too large. Stale cache files are removed once every 28 days and the cache is evicted down to
+    :data:`MAX_CACHE_SIZE <urlquick.MAX_CACHE_SIZE>`. This work is never done while making a request.
+    It's meant to be called when there is time to spare, e.g. after the listing has been shown.
+    Work that does not finish before the deadline, will be continued on the next call.
+
+    :param float deadline: [opt] Time, as returned by :func:`time.time`, after which no more work should be done.
+    :returns: True if all housekeeping is complete, else False.
+    """
+    index = CacheHandler.cache_index()
+    index.flush()
+    index.compact()
+
+    if CacheHandler.initiate_cleanup:
+        if cache_cleanup(60 * 60 * 24 * 14, deadline):
+            _addon_data.setSetting("cache_cleanup_timestamp", str(time.time()))
+        else:
+            return False
+
+    if MAX_CACHE_SIZE:
+        return cache_evict(MAX_CACHE_SIZE, deadline=deadline)
+    else:
+        return True
+
+
+def revalidate(deadline=None):
+    """
+    Refresh the stale responses that were served from the cache, because of ``stale_while_revalidate``.
+
+    It's meant to be called when there is time to spare, e.g. after the listing has been shown.
+    Responses that are not refreshed before the deadline, stay pending for the next call.
+
+    :param float deadline: [opt] Time, as returned by :func:`time.time`, after which no more requests should be made.
+    :returns: True if all stale responses have been refreshed, else False.
+    """
+    while deadline is None or time.time() < deadline:
+        with _revalidate_lock:
+            if not _pending_revalidation:
+                return True
+            uid, refresh = _pending_revalidation.popitem(last=False)
+
+        logger.debug("Revalidating stale cache: %s", uid)
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Cache Error: Failed to revalidate stale cache.")
+    return False
+
+
+# Requests to refresh stale responses that were served from the cache, keyed by cache uid
+_pending_revalidation = OrderedDict()
+_revalidate_lock = threading.Lock()
+
+
+class InFlight(object):
+    """A request that is in progress, that identical requests can wait on, to share its response."""
+
     def __init__(self):
-        self.__cache = None
+        self._done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def wait(self):
+        """Wait for the request to complete, returning its response or raising its error."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+    def finish(self, response=None, error=None):
+        """Share the response or error, with all waiting requests."""
+        self.response = response
+        self.error = error
+        self._done.set()
+
+
+# Requests that are in progress, keyed by method and cache uid
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class CacheAdapter(object):
+    @staticmethod
+    def cache_check(method, url, data, headers, max_age=None, override=False):
+        """
+        Check the cache for a response to the request.
+
+        :param bool override: [opt] True if the max age was explicitly given, and should override the server's
+                              Cache-Control and Expires headers. Defaults to ``False``.
+        :returns: A tuple of (cache handler, fresh cached response or None).
+                  The cache handler will be None if the request can not be cached.
+        """
+        # Fetch max age from request header, a max age given in the header is always explicit
+        if u"x-max-age" in headers:
+            max_age = int(headers.pop(u"x-max-age"))
+            override = True
+        elif max_age is None:
+            max_age = MAX_AGE
 
-    def cache_check(self, method, url, data, headers, max_age=None):
-        # Fetch max age from request header
-        max_age = max_age if max_age is not None else int(headers.pop(u"x-max-age", MAX_AGE))
         if method == u"OPTIONS":
-            return None
+            return None, None
 
         # Check if cache exists first
-        self.__cache = cache = CacheHandler.from_url(url, data, max_age)
+        cache = CacheHandler.from_url(url, data, max_age, override, headers)
+        if cache and not cache.matches(headers):
+            logger.debug("Cache does not match the vary headers of the request, ignoring cache")
+            cache.response = None
+
         if cache:
             if method in ("PUT", "DELETE"):
                 logger.debug("Cache purged, %s request invalidates cache", method)
                 cache.delete(cache.cache_file)
 
-            elif cache.isfresh():
+            elif cache.isfresh() and u"no-cache" not in parse_cache_control(headers.get(u"Cache-Control", u"")):
                 logger.debug("Cache is fresh, returning cached response")
-                return cache.response
+                return cache, cache.response
 
             else:
                 logger.debug("Cache is stale, checking for conditional headers")
                 cache.add_conditional_headers(headers)
 
-    def handle_response(self, method, status, callback):
+        return cache, None
+
+    @staticmethod
+    def handle_response(cache, method, status, callback):
         if status == 304:
             logger.debug("Server return 304 Not Modified response, using cached response")
-            callback()
-            self.__cache.reset_timestamp()
-            return self.__cache.response
+            cache.revalidated(callback()[0])
+            return cache.response
 
         # Cache any cachable response
         elif status in CACHEABLE_CODES and method.upper() in CACHEABLE_METHODS:
             response = callback()
+            if not cache.storable(response[0]):
+                logger.debug("Server does not allow the response to be cached")
+                if cache:
+                    cache.delete(cache.cache_file)
+                return None
+
             logger.debug("Caching %s %s response", status, response[3])
 
             # Save response to cache and return the cached response
-            self.__cache.update(*response)
-            return self.__cache.response
+            cache.update(*response)
+            return cache.response
 
 
 class CacheResponse(object):
     """A mock HTTPResponse class"""
 
-    def __init__(self, headers, body, status, reason, version=11, strict=True):
+    def __init__(self, headers, body, status, reason, version=11, strict=True, vary=None):
+        self.vary = vary if vary is not None else {}
         self.headers = headers
         self.status = status
         self.reason = reason
         self.version = version
         self.strict = strict
         self.body = body
+        self._stream = None
+
+    def getheaders(self):
+        """Return the response headers"""
+        return self.headers
+
+    def read(self, amt=None):
+        """Return the body of the response, or up to amt bytes of the rest of the body when read in chunks"""
+        if amt is None:
+            return self.body
+        if self._stream is None:
+            self._stream = BytesIO(self.body)
+        return self._stream.read(amt)
+
+    def copy(self):
+        """Return a copy of the response, sharing the body, that can be read in chunks independently."""
+        return CacheResponse(self.headers, self.body, self.status, self.reason, self.version, self.strict, self.vary)
+
+    def close(self):
+        self._stream = None
+
+
+class StreamResponse(object):
+    """
+    A response with a body that is read from the connection on demand.
+
+    The connection is released back to the pool once the body has been fully read,
+    or discarded if the response is closed before then.
+
+    :param response: The http response.
+    :param release: Function to release the connection, called with True if the connection can be reused.
+    :param CacheWriter writer: [opt] Writer to pass the body through to the cache as it's read.
+    """
+
+    def __init__(self, response, release, writer=None):
+        self.status = response.status
+        self.reason = response.reason
+        self.version = response.version
+        self.headers = response.getheaders()
+        self._response = response
+        self._release = release
+        self._writer = writer
+
+        # Release the connection straight away if there is no body to read
+        if response.isclosed() or getattr(response, "length", None) == 0:
+            self.read()
 
     def getheaders(self):
         """Return the response headers"""
         return self.headers
 
-    def read(self):
-        """Return the body of the response"""
-        return self.body
+    @property
+    def caching(self):
+        """True if the body is being written to the cache as it's read."""
+        return self._writer is not None and self._response is not None
+
+    def read(self, amt=None):
+        """
+        Read and return up to amt bytes of the body, or the rest of the body if amt is not given.
+
+        :raises ConnError: If the connection failed while reading the body.
+        :raises Timeout: If the connection to server timed out.
+        """
+        response = self._response
+        if response is None:
+            return b""
+
+        try:
+            data = response.read(amt) if amt else response.read()
+        except (socket.error, HTTPException) as e:
+            self.close()
+            if isinstance(e, socket.timeout):
+                raise Timeout(e)
+            elif isinstance(e, ssl.SSLError):
+                raise SSLError(e)
+            else:
+                raise ConnError(e)
+
+        if self._writer is not None:
+            self._writer.write(data)
+        if not data or response.isclosed():
+            self._finish()
+        return data
+
+    def _finish(self):
+        """Complete the cache and release the connection once the body has been fully read."""
+        response, self._response = self._response, None
+        if self._writer is not None:
+            self._writer.commit()
+        response.close()
+        self._release(not response.will_close)
 
     def close(self):
-        pass
+        """Close the response, the connection is discarded if the body has not been fully read."""
+        response, self._response = self._response, None
+        if response is not None:
+            if self._writer is not None:
+                self._writer.abort()
+            response.close()
+            self._release(False)
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of persistent connections, with a limit on the number of connections per host.
+
+    Idle connections are closed once they have been idle for longer than the idle timeout,
+    and are checked to still be alive before being reused.
+
+    :param int max_per_host: Max number of connections, in use or idle, to a single host.
+    :param int idle_timeout: Seconds a connection can be idle, before it's closed instead of reused.
+
+    :ivar dict metrics: Counters of "hits" (idle connection reused), "misses" (new connection required),
+                        "reconnects" (reused connection failed and was replaced) and "expired"
+                        (idle connection closed as it timed out or was found dead).
+    """
+
+    def __init__(self, max_per_host=MAX_CONNECTIONS, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+        self.max_per_host = max(max_per_host, 1)
+        self.idle_timeout = idle_timeout
+        self.metrics = {"hits": 0, "misses": 0, "reconnects": 0, "expired": 0}
+        self._cond = threading.Condition()
+        self._idle = defaultdict(list)  # key -> list of (connection, last used)
+        self._active = defaultdict(int)  # key -> number of checked out connections
+
+    def checkout(self, key, timeout=None):
+        """
+        Wait for a free connection slot to the host, and return an idle connection to reuse.
+
+        The slot is held until :meth:`checkin` is called, even if no connection was returned.
+
+        :param key: The key of the host, e.g. (scheme, host).
+        :param float timeout: [opt] Max seconds to wait for a free slot, waits forever if not given.
+        :returns: A live idle connection, or None if a new connection needs to be created.
+        :raises Timeout: If no slot became free within the timeout.
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while self._active[key] >= self.max_per_host:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Timeout("Timed out waiting for a free connection to host: {}".format(key[1]))
+                self._cond.wait(remaining)
+            self._active[key] += 1
+
+            # Close all idle connections that have timed out, the oldest are at the start
+            idle = self._idle[key]
+            expire_time = time.time() - self.idle_timeout
+            while idle and idle[0][1] < expire_time:
+                idle.pop(0)[0].close()
+                self.metrics["expired"] += 1
+
+            # Use the most recently used connection, as it's the least likely to have been closed by the server
+            while idle:
+                conn = idle.pop()[0]
+                if self.is_alive(conn):
+                    self.metrics["hits"] += 1
+                    return conn
+
+                conn.close()
+                self.metrics["expired"] += 1
+
+            self.metrics["misses"] += 1
+            return None
+
+    def checkin(self, key, conn, reusable=True):
+        """
+        Release the connection slot to the host, keeping the connection for reuse if possible.
+
+        :param key: The key of the host, e.g. (scheme, host).
+        :param conn: The connection to return, can be None.
+        :param bool reusable: [opt] False if the connection can not be reused. Defaults to ``True``.
+        """
+        with self._cond:
+            self._active[key] -= 1
+            if conn is not None:
+                if reusable:
+                    self._idle[key].append((conn, time.time()))
+                else:
+                    conn.close()
+            self._cond.notify()
+
+    def reconnected(self):
+        """Record that a reused connection failed and had to be replaced."""
+        with self._cond:
+            self.metrics["reconnects"] += 1
+
+    @staticmethod
+    def is_alive(conn):
+        """
+        Check if an idle connection can be reused.
+
+        An idle keep-alive socket should have nothing to read, if it's readable
+        then the server has closed the connection or sent unexpected data.
+        """
+        sock = conn.sock
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (ValueError, select.error, socket.error):
+            return False
+        else:
+            return not readable
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._cond:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop()[0].close()
 
 
 class ConnectionManager(CacheAdapter):
-    def __init__(self):
-        self.request_handler = {"http": {}, "https": {}}
+    """
+    Sends requests through the cache, over a pool of persistent connections.
+
+    :param int max_connections: [opt] Max number of connections to a single host.
+                                Defaults to :data:`MAX_CONNECTIONS <urlquick.MAX_CONNECTIONS>`
+    :param int idle_timeout: [opt] Seconds a connection can be idle before it's closed.
+                             Defaults to :data:`CONNECTION_IDLE_TIMEOUT <urlquick.CONNECTION_IDLE_TIMEOUT>`
+    """
+
+    def __init__(self, max_connections=None, idle_timeout=None):
+        self.pool = ConnectionPool(MAX_CONNECTIONS if max_connections is None else max_connections,
+                                   CONNECTION_IDLE_TIMEOUT if idle_timeout is None else idle_timeout)
         super(ConnectionManager, self).__init__()
 
-    def make_request(self, req, timeout, verify, max_age):
+    @property
+    def metrics(self):
+        """Return a copy of the connection pool metrics."""
+        return dict(self.pool.metrics)
+
+    def make_request(self, req, timeout, verify, max_age, stream=False, stale_while_revalidate=False,
+                     stale_if_error=False, override=False):
+        args = (req, timeout, verify, max_age, stream, stale_while_revalidate, stale_if_error, override)
+
+        # Only one identical request is sent at a time, streamed responses can't be shared
+        if stream or req.method not in (u"GET", u"HEAD"):
+            return self._make_request(*args)
+
+        # Requests are only identical if all headers match, the response can depend on any of
+        # them through Vary, and the auth or cookie headers must never leak into another request.
+        # The cache options must also match, as they decide if a cached or stale response can be used.
+        headers = tuple(sorted((key.lower(), value) for key, value in req.headers.items()))
+        key = (req.method, CacheHandler.hash_url(req.url, req.data), headers, verify, max_age,
+               stale_while_revalidate, stale_if_error, override)
+        with _in_flight_lock:
+            flight = _in_flight.get(key)
+            if flight is None:
+                _in_flight[key] = leader = InFlight()
+
+        if flight is not None:
+            logger.debug("Identical request in progress, waiting to share its response")
+            return flight.wait()
+
+        response = error = None
+        try:
+            response = self._make_request(*args)
+        except Exception as e:
+            error = e
+            raise
+        except BaseException:
+            # The request was interrupted, e.g. by SystemExit when Kodi aborts
+            error = UrlError("Identical request in progress was interrupted")
+            raise
+        finally:
+            # The waiting requests must always be released, else they would wait forever
+            with _in_flight_lock:
+                del _in_flight[key]
+            leader.finish(response, error)
+        return response
+
+    def _make_request(self, req, timeout, verify, max_age, stream=False, stale_while_revalidate=False,
+                      stale_if_error=False, override=False):
         # Only check cache if max_age set to a valid value
         if max_age >= 0:
-            cached_resp = self.cache_check(req.method, req.url, req.data, req.headers, max_age=max_age)
+            cache, cached_resp = self.cache_check(req.method, req.url, req.data, req.headers, max_age, override)
             if cached_resp:
                 return cached_resp
 
-            # Request resource and cache it if possible
-            resp = self.connect(req, timeout, verify)
-            callback = lambda: (resp.getheaders(), resp.read(), resp.status, resp.reason)
-            cached_resp = self.handle_response(req.method, resp.status, callback)
-            if cached_resp:
-                return cached_resp
-            else:
-                return resp
+            # Only safe requests can fallback to a stale response
+            stale = cache if cache and req.method in (u"GET", u"HEAD") else None
+            if stale and stale.usable_stale(stale_while_revalidate):
+                logger.debug("Cache is stale, returning stale response and revalidating later")
+                with _revalidate_lock:
+                    _pending_revalidation[stale.uid] = partial(self.make_request, req, timeout, verify, max_age,
+                                                               override=override)
+                return stale.response
 
-        # Default to un-cached response
-        return self.connect(req, timeout, verify)
-
-    def connect(self, req, timeout, verify):
-        # Fetch connection from pool and attempt to reuse if available
-        pool = self.request_handler[req.type]
-        if req.host in pool:
+            # Request resource and cache it if possible, streamed responses are cached as they are read
             try:
-                # noinspection PyTypeChecker
-                return self.send_request(pool[req.host], req)
-            except Exception as e:
-                # Remove the connection from the pool as it's unusable
-                pool[req.host].close()
-                del pool[req.host]
-
-                # Raise the exception if it's not a subclass of UrlError
-                if not isinstance(e, UrlError):
-                    raise
+                resp = self.connect(req, timeout, verify, stream, cache)
+            except UrlError as e:
+                if stale and stale.usable_stale(stale_if_error):
+                    logger.warning("Request failed, returning stale response from cache: %s", e)
+                    return stale.response
+                raise
+
+            if stale and resp.status in (500, 502, 503, 504) and stale.usable_stale(stale_if_error):
+                logger.warning("Server returned %s, returning stale response from cache", resp.status)
+                resp.close()
+                return stale.response
+
+            if cache is not None and (not stream or resp.status == 304):
+                callback = lambda: (resp.getheaders(), resp.read(), resp.status, resp.reason)
+                cached_resp = self.handle_response(cache, req.method, resp.status, callback)
+                if cached_resp:
+                    return cached_resp
+            return resp
 
-        # Create a new connection
-        if req.type == "https":
-            # noinspection PyProtectedMember
-            context = ssl._create_unverified_context() if verify is False else None
-            conn = HTTPSConnection(req.host, timeout=timeout, context=context)
-        else:
-            conn = HTTPConnection(req.host, timeout=timeout)
-
-        # Make first connection to server
-        response = self.send_request(conn, req)
+        # Default to un-cached response
+        return self.connect(req, timeout, verify, stream)
 
-        # Add connection to the pool if the response is not set to close
-        if not response.will_close:
-            pool[req.host] = conn
-        return response
+    def connect(self, req, timeout, verify, stream=False, cache=None):
+        # Unverified https connections are kept apart from verified connections
+        key = (req.type, req.host, verify is False)
+        conn = self.pool.checkout(key, timeout)
+        response = None
+        try:
+            if conn is not None:
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                try:
+                    response, reusable = self.send_request(conn, req, stream)
+                except UrlError:
+                    # The server must have closed the connection, so retry with a new connection
+                    conn.close()
+                    self.pool.reconnected()
+
+            if response is None:
+                # Create a new connection
+                if req.type == "https":
+                    # noinspection PyProtectedMember
+                    context = ssl._create_unverified_context() if verify is False else None
+                    conn = HTTPSConnection(req.host, timeout=timeout, context=context)
+                else:
+                    conn = HTTPConnection(req.host, timeout=timeout)
+
+                response, reusable = self.send_request(conn, req, stream)
+
+        except Exception:
+            # The connection is closed by the pool as it can't be reused
+            self.pool.checkin(key, conn, False)
+            raise
+
+        if stream:
+            # The connection is released by the response, once the body has been read
+            writer = None
+            if cache is not None and response.status in CACHEABLE_CODES and \
+                    req.method.upper() in CACHEABLE_METHODS and cache.storable(response.getheaders()):
+                writer = cache.writer(response.getheaders(), response.status, response.reason, response.version)
+            return StreamResponse(response, lambda reuse: self.pool.checkin(key, conn, reuse), writer)
+        else:
+            self.pool.checkin(key, conn, reusable)
+            return response
 
     @staticmethod
-    def send_request(conn, req):
+    def send_request(conn, req, stream=False):
+        """
+        Send the request and read in the response.
+
+        :returns: A tuple of (response, reusable), reusable is False if the connection can not be reused.
+                  If streaming, the raw response is returned with the body left unread, and reusable is None.
+        """
         try:
             # Setup request
             conn.putrequest(str(req.method), str(req.selector), skip_host=1, skip_accept_encoding=1)
@@ -585,7 +1938,13 @@ class ConnectionManager(CacheAdapter):
 
             # Send the body of the request witch will initiate the connection
             conn.endheaders(req.data)
-            return conn.getresponse()
+            response = conn.getresponse()
+            if stream:
+                return response, None
+
+            # Read the full body so that the connection can be reused straight away
+            body = response.read()
+            response.close()
 
         except socket.timeout as e:
             raise Timeout(e)
@@ -596,12 +1955,13 @@ class ConnectionManager(CacheAdapter):
         except (socket.error, HTTPException) as e:
             raise ConnError(e)
 
+        else:
+            return CacheResponse(response.getheaders(), body, response.status, response.reason,
+                                 response.version), not response.will_close
+
     def close(self):
         """Close all persistent connections and remove."""
-        for pool in self.request_handler.values():
-            for key in list(pool.keys()):
-                conn = pool.pop(key)
-                conn.close()
+        self.pool.clear()
 
 
 class Request(object):
@@ -794,11 +2154,21 @@ class Session(ConnectionManager):
     :ivar bool allow_redirects: Enable/disable redirection. Defaults to ``True``
     :ivar bool raise_for_status: Raise HTTPError if status code is > 400. Defaults to ``False``
     :ivar int max_age: Max age the cache can be, before it’s considered stale. -1 will disable caching.
+                       Only used when the server gives no Cache-Control or Expires header.
                        Defaults to :data:`MAX_AGE <urlquick.MAX_AGE>`
+    :ivar int max_connections: Max number of connections to a single host.
+                               Defaults to :data:`MAX_CONNECTIONS <urlquick.MAX_CONNECTIONS>`
+    :ivar int idle_timeout: Seconds a persistent connection can be idle before it's closed.
+                            Defaults to :data:`CONNECTION_IDLE_TIMEOUT <urlquick.CONNECTION_IDLE_TIMEOUT>`
+    :ivar stale_while_revalidate: Return stale cache straight away and refresh it on the next call to
+                                  :func:`revalidate <urlquick.revalidate>`. ``True``, or seconds past the max age
+                                  that the cache can be returned. Defaults to ``False``
+    :ivar stale_if_error: Return stale cache if the request fails, or the server returns a 5xx error.
+                          ``True``, or seconds past the max age that the cache can be returned. Defaults to ``False``
     """
 
     def __init__(self, **kwargs):
-        super(Session, self).__init__()
+        super(Session, self).__init__(kwargs.get("max_connections"), kwargs.get("idle_timeout"))
         self._headers = CaseInsensitiveDict()
 
         # Set Default headers
@@ -819,6 +2189,8 @@ class Session(ConnectionManager):
         self.max_redirects = kwargs.get("max_redirects", 10)
         self.allow_redirects = kwargs.get("allow_redirects", True)
         self.raise_for_status = kwargs.get("raise_for_status", True)
+        self.stale_while_revalidate = kwargs.get("stale_while_revalidate", False)
+        self.stale_if_error = kwargs.get("stale_if_error", False)
 
     @property
     def auth(self):
@@ -977,8 +2349,89 @@ class Session(ConnectionManager):
         """
         return self.request(u"DELETE", url, **kwargs)
 
+    def map(self, requests, max_workers=4, ordered=True):
+        """
+        Make multiple requests concurrently, using a bounded pool of worker threads.
+
+        All requests go through the cache, and connections are reused between requests
+        to the same host. Requests to a single host are also limited by the max connections of the session.
+
+        :param requests: Iterable of urls, or dicts of keyword arguments that :meth:`request` takes.
+                         The request method defaults to "GET" if not given.
+        :param int max_workers: [opt] Max number of requests to make at the same time. Defaults to 4.
+        :param bool ordered: [opt] Yield the responses in the same order as the requests, if ``False`` the responses
+                             are yielded as soon as they complete. Defaults to ``True``.
+
+        :return: A generator of (index, response) tuples, where index is the position of the request.
+
+        :raises UrlError: The error raised by a request, once that request is reached.
+        """
+        jobs = Queue()
+        for job in enumerate(requests):
+            jobs.put(job)
+
+        total = jobs.qsize()
+        results = Queue()
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    index, kwargs = jobs.get_nowait()
+                except Empty:
+                    break
+
+                kwargs = dict(kwargs) if isinstance(kwargs, dict) else {"url": kwargs}
+                kwargs.setdefault("method", u"GET")
+                try:
+                    results.put((index, self.request(**kwargs), None))
+                except Exception as e:
+                    results.put((index, None, e))
+
+        for _ in range(min(max_workers, total)):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_index = 0
+        try:
+            for _ in range(total):
+                result = results.get()
+                if ordered:
+                    pending[result[0]] = result
+                    while next_index in pending:
+                        index, resp, error = pending.pop(next_index)
+                        if error is not None:
+                            raise error
+                        yield index, resp
+                        next_index += 1
+                else:
+                    index, resp, error = result
+                    if error is not None:
+                        raise error
+                    yield index, resp
+        finally:
+            # Stop the workers from starting any more requests
+            stop.set()
+
+    def fetch_all(self, urls, max_workers=4, **kwargs):
+        """
+        Sends GET requests for all the given urls concurrently.
+
+        :param urls: Iterable of urls to request.
+        :param int max_workers: [opt] Max number of requests to make at the same time. Defaults to 4.
+        :param kwargs: Optional arguments that :func:`request <urlquick.request>` takes.
+
+        :return: A list of responses, in the same order as the urls.
+        :rtype: list
+        """
+        requests = [dict(kwargs, url=url) for url in urls]
+        return [resp for _, resp in self.map(requests, max_workers)]
+
     def request(self, method, url, params=None, data=None, headers=None, cookies=None, auth=None,
-                timeout=10, allow_redirects=None, verify=True, json=None, raise_for_status=None, max_age=None):
+                timeout=10, allow_redirects=None, verify=True, json=None, raise_for_status=None, max_age=None,
+                stream=False, stale_while_revalidate=None, stale_if_error=None):
         """
         Make request for remote resource.
 
@@ -998,7 +2451,15 @@ class Session(ConnectionManager):
         :param bool verify: [opt] Controls whether to verify the server's TLS certificate. Defaults to ``True``
         :param bool raise_for_status: [opt] Raise's HTTPError if status code is > 400. Defaults to ``False``.
         :param int max_age: [opt] Age the 'cache' can be, before it’s considered stale. -1 will disable caching.
-                            Defaults to :data:`MAX_AGE <urlquick.MAX_AGE>`
+                            When given, overrides the server's Cache-Control and Expires headers.
+                            Defaults to the session max age.
+        :param bool stream: [opt] Defer reading the response body until it's accessed, so that it can be
+                            read incrementally with :meth:`iter_content <urlquick.Response.iter_content>`.
+                            Defaults to ``False``.
+        :param stale_while_revalidate: [opt] Return stale cache straight away and refresh it later.
+                                       ``True``, or seconds past the max age. Defaults to the session setting.
+        :param stale_if_error: [opt] Return stale cache if the request fails, or the server returns a 5xx error.
+                               ``True``, or seconds past the max age. Defaults to the session setting.
     
         :return: A requests like Response object.
         :rtype: urlquick.Response
@@ -1012,6 +2473,10 @@ class Session(ConnectionManager):
         # Fetch settings from local or session
         allow_redirects = self.allow_redirects if allow_redirects is None else allow_redirects
         raise_for_status = self.raise_for_status if raise_for_status is None else raise_for_status
+        if stale_while_revalidate is None:
+            stale_while_revalidate = self.stale_while_revalidate
+        if stale_if_error is None:
+            stale_if_error = self.stale_if_error
 
         # Ensure that all mappings of unicode data
         req_headers = CaseInsensitiveDict(self._headers, headers)
@@ -1023,7 +2488,8 @@ class Session(ConnectionManager):
             header = u"; ".join([u"{}={}".format(key, value) for key, value in req_cookies.items()])
             req_headers[u"Cookie"] = header
 
-        # Fetch max age of cache
+        # Fetch max age of cache, an explicit max age overrides the server's caching headers
+        override = max_age is not None
         max_age = (-1 if self.max_age is None else self.max_age) if max_age is None else max_age
 
         # Parse url into it's individual components including params if given
@@ -1047,13 +2513,15 @@ class Session(ConnectionManager):
 
         while True:
             # Send a request for resource
-            raw_resp = self.make_request(req, timeout, verify, max_age)
-            resp = Response(raw_resp, req, start_time, history[:])
+            raw_resp = self.make_request(req, timeout, verify, max_age, stream, stale_while_revalidate,
+                                         stale_if_error, override)
+            resp = Response(raw_resp, req, start_time, history[:], stream)
 
             visited[req.url] += 1
             # Process the response
             if allow_redirects and resp.is_redirect:
                 history.append(resp)
+                resp.close()
                 if len(history) >= self.max_redirects:
                     raise MaxRedirects("max_redirects exceeded")
                 if visited[req.url] >= self.max_repeats:
@@ -1070,12 +2538,18 @@ class Session(ConnectionManager):
             # And Authorization Credentials if needed
             elif auth and resp.status_code == 401 and u"Authorization" not in req.headers:
                 req.headers[u"Authorization"] = auth
+                resp.close()
 
             # According to RFC 2616, "2xx" code indicates that the client's
             # request was successfully received, understood, and accepted.
             # Therefore all other codes will be considered as errors.
             elif raise_for_status:
-                resp.raise_for_status()
+                try:
+                    resp.raise_for_status()
+                except HTTPError:
+                    # Release the connection of a streamed response, as the caller never gets the response
+                    resp.close()
+                    raise
                 return resp
             else:
                 return resp
@@ -1104,7 +2578,7 @@ class Response(object):
     """A Response object containing all data returned from the server."""
 
     # noinspection PyArgumentList
-    def __init__(self, response, org_request, start_time, history):
+    def __init__(self, response, org_request, start_time, history, stream=False):
         #: The default encoding, used when no encoding is given.
         self.apparent_encoding = "utf8"
 
@@ -1131,9 +2605,16 @@ class Response(object):
         #: Textual reason of response HTTP Status e.g. “Not Found” or “OK”.
         self.reason = unicode(response.reason)
 
-        # Fetch content body
-        self._body = response.read()
-        response.close()
+        # Fetch content body, unless the body is to be streamed
+        self._consumed = False
+        if stream:
+            # Cached responses can be shared between requests, so each stream needs its own read position
+            if isinstance(response, CacheResponse):
+                self.raw = response = response.copy()
+            self._body = None
+        else:
+            self._body = response.read()
+            response.close()
 
         # Fetch response headers and convert to CaseInsensitiveDict if needed
         headers = response.getheaders()
@@ -1164,20 +2645,73 @@ class Response(object):
         :raises ContentError: If content failes to decompress.
         """
         # Check if Response need to be decoded, else return raw response
+        body = self._read_body()
+        decoder = self._decoder()
+        if decoder is None:
+            return body
+
+        try:
+            return decoder.decompress(body)
+        except (IOError, zlib.error) as e:
+            raise ContentError("Failed to decompress content body: {}".format(e))
+
+    def _read_body(self):
+        """Return the raw body, reading the rest of the body if streaming."""
+        if self._body is None:
+            if self._consumed:
+                raise RuntimeError("The content for this response was already consumed")
+            self._body = self.raw.read()
+            self.raw.close()
+        return self._body
+
+    def _decoder(self):
+        """Return a decompressor for the content encoding, or None if the content is not encoded."""
         content_encoding = self._headers.get(u"content-encoding", u"").lower()
         if u"gzip" in content_encoding:
-            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
         elif u"deflate" in content_encoding:
-            decoder = zlib.decompressobj()
+            return zlib.decompressobj()
         elif content_encoding:
             raise ContentError("Unknown encoding: {}".format(content_encoding))
         else:
-            return self._body
+            return None
 
+    def _stream_content(self, chunk_size):
+        """Read the body from the connection one chunk at a time, decompressing on the fly."""
+        self._consumed = True
+        decoder = self._decoder()
+        raw = self.raw
         try:
-            return decoder.decompress(self._body)
-        except (IOError, zlib.error) as e:
-            raise ContentError("Failed to decompress content body: {}".format(e))
+            while True:
+                data = raw.read(chunk_size)
+                if not data:
+                    break
+                if decoder is not None:
+                    try:
+                        data = decoder.decompress(data)
+                    except zlib.error as e:
+                        raise ContentError("Failed to decompress content body: {}".format(e))
+                if data:
+                    yield data
+
+            if decoder is not None:
+                data = decoder.flush()
+                if data:
+                    yield data
+        finally:
+            raw.close()
+
+    def _stream_text(self, chunks):
+        """Decode a stream of byte chunks into unicode."""
+        decoder = getincrementaldecoder(self.encoding or self.apparent_encoding or "iso-8859-1")(errors="replace")
+        for chunk in chunks:
+            data = decoder.decode(chunk)
+            if data:
+                yield data
+
+        data = decoder.decode(b"", final=True)
+        if data:
+            yield data
 
     @CachedProperty
     def text(self):
@@ -1298,10 +2832,15 @@ class Response(object):
         from xml.etree import ElementTree
         return ElementTree.fromstring(self.content)
 
-    def parse(self, tag=u"", attrs=None):
+    def parse(self, tag=u"", attrs=None, chunk_size=None):
         """
         Parse's "HTML" document into a element tree using HTMLement.
 
+        When the request was made with ``stream=True``, or a chunk size is given, the document is decoded
+        and fed to the parser one chunk at a time. Parsing stops as soon as the required element has been
+        closed, so the rest of the document is never decoded. If the response is being cached, the rest of
+        the document is still read into the cache, else it's never read at all.
+
         .. seealso:: The htmlement documentation can be found at.\n
                      http://python-htmlement.readthedocs.io/en/stable/?badge=stable
 
@@ -1312,12 +2851,29 @@ class Response(object):
         :param attrs: [opt] Attributes of 'element', used when searching for required section.
                                  Attrs should be a dict of unicode key/value pairs.
 
+        :param int chunk_size: [opt] The chunk size to parse incrementally. Defaults to 16384 when streaming.
+
         :return: The root element of the element tree.
         :rtype: xml.etree.ElementTree.Element
         """
         from htmlement import HTMLement
         parser = HTMLement(unicode(tag), attrs)
-        parser.feed(self.text)
+        if chunk_size or self._body is None:
+            try:
+                for chunk in self._stream_text(self.iter_content(chunk_size or 16384)):
+                    parser.feed(chunk)
+                    # HTMLement flags when the required element has been closed
+                    if getattr(parser, "_finished", False):
+                        # Complete the cache of the response, closing now would discard it
+                        if getattr(self.raw, "caching", False):
+                            while self.raw.read(65536):
+                                pass
+                        break
+            finally:
+                # Release the connection, if the rest of the body was not needed
+                self.close()
+        else:
+            parser.feed(self.text)
         return parser.close()
 
     def iter_content(self, chunk_size=512, decode_unicode=False):
@@ -1329,7 +2885,16 @@ class Response(object):
                                (default=512)
         :param bool decode_unicode: [opt] ``True`` to return unicode, else ``False`` to return bytes.
                                     (default=``False``)
+
+        .. note:: When the request was made with ``stream=True``, the body is read from the connection
+                  as it's iterated, and can only be iterated over once.
         """
+        if self._body is None:
+            chunks = self._stream_content(chunk_size)
+            for chunk in (self._stream_text(chunks) if decode_unicode else chunks):
+                yield chunk
+            return
+
         content = self.text if decode_unicode else self.content
         prevnl = 0
         while True:
@@ -1345,18 +2910,27 @@ class Response(object):
         """
         Iterates over the response data, one line at a time.
 
-        :param int chunk_size: [opt] Unused, here for compatibility with requests.
+        :param int chunk_size: [opt] The chunk size to read, only used when streaming.
         :param bool decode_unicode: [opt] ``True`` to return unicode, else ``False`` to return bytes.
                                     (default=``False``)
         :param bytes delimiter: [opt] Delimiter used as the end of line marker.
                                 (default=b'\\\\n')
         """
         if decode_unicode:
-            content = self.text
             # noinspection PyArgumentList
             delimiter = unicode(delimiter)
-        else:
-            content = self.content
+
+        if self._body is None:
+            pending = delimiter[:0]
+            for chunk in self.iter_content(chunk_size or 512, decode_unicode):
+                lines = (pending + chunk).split(delimiter)
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+            yield pending
+            return
+
+        content = self.text if decode_unicode else self.content
 
         prevnl = 0
         sepsize = len(delimiter)
@@ -1381,7 +2955,8 @@ class Response(object):
             raise HTTPError(self.url, self.status_code, self.reason, self.headers)
 
     def close(self):
-        pass
+        """Release the connection, if the response is streaming, without reading the rest of the body."""
+        self.raw.close()
 
     def __iter__(self):
         """Allows to use a response as an iterator."""
@@ -1400,7 +2975,8 @@ class Response(object):
 
 
 def request(method, url, params=None, data=None, headers=None, cookies=None, auth=None,
-            timeout=10, allow_redirects=None, verify=True, json=None, raise_for_status=None, max_age=None):
+            timeout=10, allow_redirects=None, verify=True, json=None, raise_for_status=None, max_age=None,
+            stream=False, stale_while_revalidate=None, stale_if_error=None):
     """
     Make request for remote resource.
 
@@ -1420,7 +2996,16 @@ def request(method, url, params=None, data=None, headers=None, cookies=None, aut
     :param bool verify: [opt] Controls whether to verify the server's TLS certificate. Defaults to ``True``
     :param bool raise_for_status: [opt] Raise's HTTPError if status code is > 400. Defaults to ``False``.
     :param int max_age: [opt] Age the 'cache' can be, before it’s considered stale. -1 will disable caching.
+                        When given, overrides the server's Cache-Control and Expires headers.
                         Defaults to :data:`MAX_AGE <urlquick.MAX_AGE>`
+    :param bool stream: [opt] Defer reading the response body until it's accessed, so that it can be
+                        read incrementally with :meth:`iter_content <urlquick.Response.iter_content>`.
+                        Defaults to ``False``.
+    :param stale_while_revalidate: [opt] Return stale cache straight away and refresh it on the next call to
+                                   :func:`revalidate <urlquick.revalidate>`. ``True``, or seconds past the max age.
+                                   Defaults to ``False``.
+    :param stale_if_error: [opt] Return stale cache if the request fails, or the server returns a 5xx error.
+                           ``True``, or seconds past the max age. Defaults to ``False``.
 
     :return: A requests like Response object.
     :rtype: urlquick.Response
@@ -1433,7 +3018,8 @@ def request(method, url, params=None, data=None, headers=None, cookies=None, aut
     """
     with Session() as session:
         return session.request(method, url, params, data, headers, cookies, auth, timeout,
-                               allow_redirects, verify, json, raise_for_status, max_age)
+                               allow_redirects, verify, json, raise_for_status, max_age, stream,
+                               stale_while_revalidate, stale_if_error)
 
 
 def get(url, params=None, **kwargs):
@@ -1537,3 +3123,18 @@ def delete(url, **kwargs):
     """
     with Session() as session:
         return session.request(u"DELETE", url, **kwargs)
+
+
+def fetch_all(urls, max_workers=4, **kwargs):
+    """
+    Sends GET requests for all the given urls concurrently.
+
+    :param urls: Iterable of urls to request.
+    :param int max_workers: [opt] Max number of requests to make at the same time. Defaults to 4.
+    :param kwargs: Optional arguments that :func:`request <urlquick.request>` takes.
+
+    :return: A list of responses, in the same order as the urls.
+    :rtype: list
+    """
+    with Session() as session:
+        return session.fetch_all(urls, max_workers, **kwargs)
@@ -287,7 +287,8 @@ class Context(unittest.TestCase):
 
         self.assertEqual(label, "test label")
         self.assertTrue(command.startswith("XBMC.Container.Update(plugin://script.module.codequick/"
-                                           "tests/test_listing/test_callback?_pickle_="))
+                                           "tests/test_listing/test_callback?"))
+        self.assertIn("_cq_=", command)
 
     def test_script(self):
         self.base.script(self.test_callback, "test label")
@@ -303,7 +304,8 @@ class Context(unittest.TestCase):
 
         self.assertEqual(label, "test label")
         self.assertTrue(command.startswith("XBMC.RunPlugin(plugin://script.module.codequick/"
-                                           "tests/test_listing/test_callback?_pickle_="))
+                                           "tests/test_listing/test_callback?"))
+        self.assertIn("_cq_=", command)
 
     def test_related(self):
         self.base.related(self.test_callback)
@@ -319,7 +321,8 @@ class Context(unittest.TestCase):
 
         self.assertEqual(label, "Related Videos")
         self.assertTrue(command.startswith("XBMC.Container.Update(plugin://script.module.codequick/"
-                                           "tests/test_listing/test_callback?_pickle_="))
+                                           "tests/test_listing/test_callback?"))
+        self.assertIn("_cq_=", command)
 
     def test_close(self):
         self.base.related(self.test_callback)
@@ -389,7 +392,8 @@ class TestListitem(unittest.TestCase):
     def test_close_route_params(self):
         self.listitem.set_callback(self.route_callback, "yes", full=True)
         path, raw_listitem, isfolder = self.listitem._close()
-        self.assertTrue(path.startswith("plugin://script.module.codequick/tests/test_listing/route_callback?_pickle_="))
+        self.assertTrue(path.startswith("plugin://script.module.codequick/tests/test_listing/route_callback?"))
+        self.assertIn("_cq_=j", path)
         self.assertTrue(isfolder)
 
     def test_close_resolver(self):
@@ -0,0 +1,65 @@
+import unittest
+import logging
+import json
+import time
+import sys
+import os
+
+# Testing specific imports
+from codequick import profiler, storage
+
+
+class Profiler(unittest.TestCase):
+    def setUp(self):
+        profiler.enabled = True
+
+    def tearDown(self):
+        profiler.uninstall()
+        profiler.enabled = bool(profiler.setting)
+        del profiler.phases[:]
+        del profiler.imports[:]
+
+    def test_phase_disabled(self):
+        profiler.enabled = False
+        with profiler.phase("test"):
+            pass
+        self.assertListEqual(profiler.phases, [])
+
+    def test_phase(self):
+        start_time = time.time()
+        with profiler.phase("test"):
+            pass
+
+        report = profiler.report(start_time)
+        self.assertEqual(len(report["phases"]), 1)
+        self.assertEqual(report["phases"][0]["name"], "test")
+        self.assertGreaterEqual(report["total"], report["phases"][0]["duration"])
+
+    def test_imports(self):
+        profiler.install()
+        __import__("json")  # Already imported, so not timed
+        sys.modules.pop("wave", None)
+        __import__("wave")
+        profiler.uninstall()
+
+        modules = [item["module"] for item in profiler.imports]
+        self.assertNotIn("json", modules)
+        self.assertIn("wave", modules)
+
+    def test_finish_saved(self):
+        path = os.path.join(storage.profile_dir, "profile.json")
+        org_setting = profiler.setting
+        profiler.setting = path
+        try:
+            with profiler.phase("test"):
+                pass
+            profiler.finish(time.time(), logging.getLogger())
+        finally:
+            profiler.setting = org_setting
+
+        with open(path) as stream:
+            report = json.load(stream)
+        os.remove(path)
+
+        self.assertEqual(report["phases"][0]["name"], "test")
+        self.assertListEqual(profiler.phases, [])
@@ -45,6 +45,50 @@ class StorageDict(unittest.TestCase):
             db.flush()
             self.assertIn("test", db)
 
+    def test_flush_clean(self):
+        with storage.PersistentDict(self.filename) as db:
+            db["test"] = "data"
+
+        mtime = os.stat(self.path).st_mtime
+        time.sleep(0.01)
+        with storage.PersistentDict(self.filename) as db:
+            self.assertFalse(db._dirty)
+            self.assertEqual(db["test"], "data")
+
+        self.assertEqual(os.stat(self.path).st_mtime, mtime)
+
+    def test_flush_clean_tracked(self):
+        with storage.PersistentDict(self.filename, track_changes=True) as db:
+            db["test"] = "data"
+
+        mtime = os.stat(self.path).st_mtime
+        time.sleep(0.01)
+        with storage.PersistentDict(self.filename, track_changes=True) as db:
+            self.assertEqual(db["test"], "data")
+
+        self.assertEqual(os.stat(self.path).st_mtime, mtime)
+
+    def test_modified_in_place(self):
+        with storage.PersistentDict(self.filename) as db:
+            db["test"] = []
+
+        with storage.PersistentDict(self.filename) as db:
+            db["test"].append("data")
+
+        with storage.PersistentDict(self.filename) as db:
+            self.assertListEqual(db["test"], ["data"])
+
+    def test_modified_in_place_tracked(self):
+        with storage.PersistentDict(self.filename, track_changes=True) as db:
+            db["test"] = []
+
+        # Only assignments are saved when tracking changes
+        with storage.PersistentDict(self.filename, track_changes=True) as db:
+            db["test"].append("data")
+
+        with storage.PersistentDict(self.filename) as db:
+            self.assertListEqual(db["test"], [])
+
     def test_persistents(self):
         with storage.PersistentDict(self.filename) as db:
             db["persistent"] = "true"
@@ -115,6 +159,225 @@ class StorageDict(unittest.TestCase):
             self.assertNotIn("one", db)
             self.assertNotIn("two", db)
 
+    def test_ttl_purge(self):
+        with storage.PersistentDict(self.filename, 0.2) as db:
+            db["one"] = 1
+            time.sleep(0.3)
+            db["two"] = 2
+            self.assertNotIn("one", db)
+            self.assertEqual(len(db), 1)
+            self.assertListEqual(list(db.items()), [("two", 2)])
+
+        with storage.PersistentDict(self.filename, 60) as db:
+            self.assertNotIn("one", db)
+            self.assertIn("two", db)
+
+        # The expiry heap is rebuilt from the data, it's never stored
+        with open(self.path, "rb") as stream:
+            data = pickle.load(stream)
+        self.assertNotIn("__codequick_storage_expiry__", data)
+
+    def test_merge(self):
+        with storage.PersistentDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+
+        first = storage.PersistentDict(self.filename)
+        second = storage.PersistentDict(self.filename)
+        try:
+            first["three"] = 3
+            del first["one"]
+            first.flush()
+
+            second["four"] = 4
+            second["two"] = 22
+            second.flush()
+            self.assertDictEqual(dict(second.items()), {"two": 22, "three": 3, "four": 4})
+        finally:
+            first.close()
+            second.close()
+
+        with storage.PersistentDict(self.filename) as db:
+            self.assertDictEqual(dict(db.items()), {"two": 22, "three": 3, "four": 4})
+
+
+class StorageSQLiteDict(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(StorageSQLiteDict, self).__init__(*args, **kwargs)
+        self.filename = "dictfile.sqlite"
+        self.path = os.path.join(storage.profile_dir, self.filename)
+
+    def setUp(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_create_filename_part(self):
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertFalse(db)
+
+    def test_create_filename_full(self):
+        with storage.SQLiteDict(self.path) as db:
+            self.assertFalse(db)
+
+    def test_flush_with_missing_dir(self):
+        shutil.rmtree(storage.profile_dir)
+        with storage.SQLiteDict(self.filename) as db:
+            db["test"] = "data"
+            db.flush()
+            self.assertIn("test", db)
+
+    def test_persistents(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db["persistent"] = "true"
+            db["deleted"] = "true"
+
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertEqual(db["persistent"], "true")
+            del db["deleted"]
+
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertIn("persistent", db)
+            self.assertNotIn("deleted", db)
+
+    def test_lazy_load(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertDictEqual(db._cache, {})
+            self.assertEqual(db["two"], 2)
+            self.assertListEqual(list(db._cache), ["two"])
+            self.assertFalse(db._dirty)
+
+    def test_del(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+            del db["one"]
+            self.assertNotIn("one", db)
+            self.assertIn("two", db)
+            with self.assertRaises(KeyError):
+                del db["one"]
+
+    def test_len(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+            db.flush()
+            db["three"] = 3
+            self.assertEqual(len(db), 3)
+
+    def test_items(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+            db.flush()
+            self.assertDictEqual(dict(db.items()), {"one": 1, "two": 2})
+
+    def test_ttl(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db.update({"one": 1, "two": 2})
+
+        time.sleep(2)
+        with storage.SQLiteDict(self.filename, 1) as db:
+            self.assertNotIn("one", db)
+            self.assertFalse(db)
+
+    def test_bytes_key(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db[b"one"] = 1
+
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertEqual(db[u"one"], 1)
+            self.assertEqual(db[b"one"], 1)
+            self.assertListEqual(list(db), [u"one"])
+            del db[u"one"]
+
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertFalse(db)
+
+    def test_equal_keys(self):
+        with storage.SQLiteDict(self.filename) as db:
+            db[("abc", "abc")] = "tuple"
+            db[1] = "int"
+            db[(1.5, None)] = "float"
+
+        # Keys that are equal, but are built differently, must find the stored value
+        with storage.SQLiteDict(self.filename) as db:
+            self.assertEqual(db[tuple("abc abc".split())], "tuple")
+            self.assertEqual(db[1.0], "int")
+            self.assertEqual(db[True], "int")
+            self.assertEqual(db[(1.5, None)], "float")
+            self.assertEqual(len(db), 3)
+            self.assertSetEqual(set(db), {("abc", "abc"), 1, (1.5, None)})
+
+    def test_unsupported_key(self):
+        with storage.SQLiteDict(self.filename) as db:
+            with self.assertRaises(TypeError):
+                db[frozenset()] = 1
+            self.assertNotIn(frozenset(), db)
+
+
+class StorageReadOnlyDict(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(StorageReadOnlyDict, self).__init__(*args, **kwargs)
+        self.filename = "dictfile.index"
+        self.path = os.path.join(storage.profile_dir, self.filename)
+
+    def setUp(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_missing_file(self):
+        with storage.ReadOnlyDict(self.filename) as db:
+            self.assertFalse(db)
+            self.assertNotIn("one", db)
+
+    def test_build(self):
+        data = {"one": 1, "two": [2], 3: "three", (4, 5): {"six": 6}}
+        storage.ReadOnlyDict.build(self.filename, data)
+        with storage.ReadOnlyDict(self.path) as db:
+            self.assertEqual(len(db), 4)
+            self.assertEqual(db["one"], 1)
+            self.assertListEqual(db["two"], [2])
+            self.assertEqual(db[3], "three")
+            self.assertDictEqual(db[(4, 5)], {"six": 6})
+            self.assertDictEqual(dict(db.items()), data)
+            self.assertNotIn("four", db)
+            with self.assertRaises(KeyError):
+                _ = db["four"]
+
+    def test_rebuild(self):
+        storage.ReadOnlyDict.build(self.filename, {"one": 1})
+        with storage.PersistentDict("dictfile.pickle") as data:
+            data.update({"two": 2, "three": 3})
+            storage.ReadOnlyDict.build(self.filename, data)
+
+        with storage.ReadOnlyDict(self.filename) as db:
+            self.assertNotIn("one", db)
+            self.assertEqual(db["three"], 3)
+
+    def test_invalid_file(self):
+        with open(self.path, "wb") as stream:
+            pickle.dump({"one": 1}, stream, protocol=2)
+
+        with self.assertRaises(ValueError):
+            storage.ReadOnlyDict(self.filename)
+
+    def test_bytes_key(self):
+        storage.ReadOnlyDict.build(self.filename, {b"\xff": 1, u"\xe9": 2})
+        with storage.ReadOnlyDict(self.filename) as db:
+            self.assertEqual(db[b"\xff"], 1)
+            self.assertEqual(db[u"\xe9"], 2)
+
+    def test_equal_keys(self):
+        storage.ReadOnlyDict.build(self.filename, {("abc", "abc"): "tuple", 1: "int"})
+        with storage.ReadOnlyDict(self.filename) as db:
+            self.assertEqual(db[tuple("abc abc".split())], "tuple")
+            self.assertEqual(db[1.0], "int")
+            self.assertEqual(db[True], "int")
+            self.assertNotIn(frozenset(), db)
+
+    def test_unsupported_key(self):
+        with self.assertRaises(TypeError):
+            storage.ReadOnlyDict.build(self.filename, {frozenset(): 1})
+
 
 class StorageList(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -153,6 +416,26 @@ class StorageList(unittest.TestCase):
             db.flush()
             self.assertIn("data", db)
 
+    def test_dirty(self):
+        with storage.PersistentList(self.filename) as db:
+            self.assertFalse(db._dirty)
+            db.append("data")
+            self.assertTrue(db._dirty)
+            db.flush()
+            self.assertFalse(db._dirty)
+            db.remove("data")
+            self.assertTrue(db._dirty)
+
+    def test_modified_in_place(self):
+        with storage.PersistentList(self.filename) as db:
+            db.append([])
+
+        with storage.PersistentList(self.filename) as db:
+            db[0].append("data")
+
+        with storage.PersistentList(self.filename) as db:
+            self.assertListEqual(db[0], ["data"])
+
     def test_persistents(self):
         with storage.PersistentList(self.filename) as db:
             db.append("persistent")
@@ -192,6 +475,47 @@ class StorageList(unittest.TestCase):
             db.extend(["one", "two"])
             self.assertEqual(len(db), 2)
 
+    def test_journal(self):
+        with storage.PersistentList(self.filename, journal=True) as db:
+            db.extend(["one", "two", "three"])
+
+        size = os.path.getsize(self.path)
+        with storage.PersistentList(self.filename, journal=True) as db:
+            db.append("four")
+            db.remove("one")
+            db[0] = "five"
+            db.insert(0, "six")
+
+        self.assertGreater(os.path.getsize(self.path), size)
+        with storage.PersistentList(self.filename) as db:
+            self.assertListEqual(list(db), ["six", "five", "three", "four"])
+
+    def test_journal_compact(self):
+        with storage.PersistentList(self.filename, journal=True) as db:
+            for count in range(2000):
+                db.append(count)
+                db.flush()
+
+            limit = max(db._snapshot_size, storage.JOURNAL_MIN_SIZE) * storage.JOURNAL_RATIO
+            self.assertLessEqual(db._journal_size, limit)
+            self.assertGreater(db._snapshot_size, storage.JOURNAL_MIN_SIZE)
+
+        with storage.PersistentList(self.filename, journal=True) as db:
+            self.assertListEqual(list(db), list(range(2000)))
+
+    def test_journal_partial_record(self):
+        with storage.PersistentList(self.filename, journal=True) as db:
+            db.append("one")
+            db.flush()
+            db.append("two")
+
+        with open(self.path, "rb+") as stream:
+            stream.truncate(os.path.getsize(self.path) - 4)
+
+        with storage.PersistentList(self.filename, journal=True) as db:
+            self.assertListEqual(list(db), ["one"])
+            self.assertTrue(db._dirty)
+
     def test_version_convert(self):
         with open(self.path, "wb") as db:
             pickle.dump(["one", "two"], db, protocol=2)
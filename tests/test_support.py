@@ -1,8 +1,12 @@
 from contextlib import contextmanager
 import unittest
+import tempfile
 import logging
 import inspect
+import shutil
+import json
 import sys
+import os
 
 # Testing specific imports
 from codequick import support, route, script
@@ -63,6 +67,16 @@ class TestRoute(unittest.TestCase):
         self.assertEqual(len(kwargs), 2)
         self.assertDictEqual(kwargs, {"one": "True", "two": False})
 
+    def test_args_to_kwargs_cached(self):
+        org_getargspec = inspect.getfullargspec if PY3 else inspect.getargspec
+        setattr(inspect, "getfullargspec" if PY3 else "getargspec", None)
+        try:
+            kwargs = {}
+            self.route.args_to_kwargs(("True",), kwargs)
+            self.assertDictEqual(kwargs, {"one": "True"})
+        finally:
+            setattr(inspect, "getfullargspec" if PY3 else "getargspec", org_getargspec)
+
     def test_unittest_caller(self):
         ret = self.route.unittest_caller("one", two="two", return_data=True)
         self.assertTrue(ret)
@@ -158,6 +172,82 @@ class TestDispatcher(unittest.TestCase):
         self.dispatcher.run_delayed()
         self.assertTrue(Executed.yes)
 
+    def test_metacalls_revalidate(self):
+        class urlquick(object):
+            calls = []
+
+            @classmethod
+            def revalidate(cls):
+                cls.calls.append("revalidate")
+
+        self.dispatcher.register_delayed(urlquick.calls.append, ["callback"], {})
+        org_module = sys.modules.get("urlquick")
+        sys.modules["urlquick"] = urlquick
+        try:
+            self.dispatcher.run_delayed()
+        finally:
+            if org_module is None:
+                del sys.modules["urlquick"]
+            else:
+                sys.modules["urlquick"] = org_module
+
+        self.assertListEqual(urlquick.calls, ["callback", "revalidate"])
+
+    def test_register_maintenance(self):
+        def task(_):
+            pass
+
+        self.dispatcher.register_maintenance(task)
+        self.assertListEqual(self.dispatcher.registered_maintenance, [task])
+        self.dispatcher.reset()
+        self.assertListEqual(self.dispatcher.registered_maintenance, [])
+
+    def test_maintenance(self):
+        deadlines = []
+
+        def task(deadline):
+            deadlines.append(deadline)
+            raise RuntimeError("should not be raised")
+
+        self.dispatcher.register_maintenance(task)
+        self.dispatcher.register_maintenance(deadlines.append)
+        self.dispatcher.run_maintenance()
+        self.assertEqual(len(deadlines), 2)
+        self.assertEqual(deadlines[0], deadlines[1])
+        self.assertListEqual(self.dispatcher.registered_maintenance, [])
+
+    def test_import_route(self):
+        tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(tmp_dir, "lazy_routes.py"), "w") as stream:
+            stream.write("from codequick import Route\n\n\n@Route.register\ndef videos(_):\n    return False\n")
+
+        dispatcher = support.dispatcher
+        profile_dir = xbmc.translatePath(support.addon_data.getAddonInfo("profile"))
+        manifest_path = os.path.join(profile_dir, support.ROUTE_MANIFEST)
+        sys.path.insert(0, tmp_dir)
+        try:
+            # First run builds the manifest
+            dispatcher.selector = "/lazy_routes/videos"
+            dispatcher.import_route(["lazy_routes"])
+            self.assertIn("/lazy_routes/videos", dispatcher.registered_routes)
+            with open(manifest_path) as stream:
+                self.assertDictEqual(json.load(stream)["routes"], {"/lazy_routes/videos": "lazy_routes"})
+            self.assertListEqual([name for name in os.listdir(profile_dir) if name.endswith(".tmp")], [])
+
+            # Second run only imports the module from the manifest, else the missing module would fail to import
+            del dispatcher.registered_routes["/lazy_routes/videos"]
+            del sys.modules["lazy_routes"]
+            dispatcher.import_route(["lazy_routes", "missing_lazy_routes"])
+            self.assertIn("/lazy_routes/videos", dispatcher.registered_routes)
+        finally:
+            sys.path.remove(tmp_dir)
+            sys.modules.pop("lazy_routes", None)
+            dispatcher.registered_routes.pop("/lazy_routes/videos", None)
+            dispatcher.reset()
+            shutil.rmtree(tmp_dir)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+
     def test_register_root(self):
         def root():
             pass
@@ -265,36 +355,47 @@ class BuildPath(unittest.TestCase):
         ret = support.build_path(self.callback)
         self.assertEqual(ret, "plugin://script.module.codequick/root")
 
-    @unittest.skipIf(PY3, "The pickled string is specific to python 2")
-    def test_build_path_new_args_py2(self):
-        ret = support.build_path(self.callback, query={"testdata": "data"})
-        self.assertEqual("plugin://script.module.codequick/root?_pickle_="
-                         "80027d71005508746573746461746171015504646174617102732e", ret)
-
-    @unittest.skipUnless(PY3, "The pickled string is specific to python 2")
-    def test_build_path_new_args_py3(self):
+    def test_build_path_new_args(self):
         ret = support.build_path(self.callback, query={"testdata": "data"})
-        self.assertEqual("plugin://script.module.codequick/root?_pickle_="
-                         "80049516000000000000007d948c087465737464617461948c046461746194732e", ret)
+        self.assertEqual("plugin://script.module.codequick/root?testdata=data", ret)
 
-    @unittest.skipIf(PY3, "The pickled string is specific to python 2")
-    def test_build_path_extra_args_py2(self):
+    def test_build_path_extra_args(self):
         support.dispatcher.params["_title_"] = "video"
         try:
             ret = support.build_path(self.callback, testdata="data")
-            self.assertEqual("plugin://script.module.codequick/root?_pickle_="
-                             "80027d71002855075f7469746c655f71015505766964656f71"
-                             "025508746573746461746171035504646174617104752e", ret)
+            self.assertEqual("plugin://script.module.codequick/root?_title_=video&testdata=data", ret)
         finally:
             del support.dispatcher.params["_title_"]
 
-    @unittest.skipUnless(PY3, "The pickled string is specific to python 2")
-    def test_build_path_extra_args_py3(self):
-        support.dispatcher.params["_title_"] = "video"
-        try:
-            ret = support.build_path(self.callback, testdata="data")
-            self.assertEqual("plugin://script.module.codequick/root?_pickle_="
-                             "80049529000000000000007d94288c075f7469746c655f948c"
-                             "05766964656f948c087465737464617461948c046461746194752e", ret)
-        finally:
-            del support.dispatcher.params["_title_"]
+    def test_build_path_json_args(self):
+        ret = support.build_path(self.callback, query={"page": 2, "next": True})
+        query = ret.split("?", 1)[1]
+        self.assertTrue(query.startswith("_cq_=j"))
+        self.assertDictEqual(support.decode_params(query[5:]), {"page": 2, "next": True})
+
+    def test_build_path_json_text_args(self):
+        # Empty strings are not urlencoded as is, but they can still be encoded as json
+        ret = support.build_path(self.callback, query={"page": 2, "empty": u""})
+        query = ret.split("?", 1)[1]
+        self.assertTrue(query.startswith("_cq_=j"))
+        self.assertDictEqual(support.decode_params(query[5:]), {"page": 2, "empty": u""})
+
+    def test_build_path_pickle_args(self):
+        query = {"title": u"Caf\xe9 & more", "ids": [1, 2], "empty": ""}
+        ret = support.build_path(self.callback, query=query)
+        dispatcher = support.Dispatcher()
+        with mock_argv([ret, 96, "?" + ret.split("?", 1)[1]]):
+            dispatcher.parse_args()
+
+        self.assertDictEqual(dispatcher.params, query)
+
+    def test_path_builder(self):
+        path_builder = support.PathBuilder()
+        for query in ({"testdata": "data"}, {"testdata": "more", "page": 2}, {}):
+            expected = support.build_path(self.callback, query=query.copy())
+            self.assertEqual(path_builder(self.callback, query=query), expected)
+
+    def test_path_builder_args(self):
+        path_builder = support.PathBuilder()
+        ret = path_builder(self.callback, ("data",), {})
+        self.assertEqual(ret, "plugin://script.module.codequick/root?one=data")
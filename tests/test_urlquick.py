@@ -0,0 +1,840 @@
+from email.utils import formatdate
+import unittest
+import threading
+import tempfile
+import shutil
+import zlib
+import json
+import time
+import sys
+import os
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+# Testing specific imports
+import urlquick
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            responses = server.routes[self.path]
+            # The last response is repeated once all the others have been sent
+            status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+
+        time.sleep(server.delays.get(self.path, 0))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.delays = {}
+        self.hits = {}
+
+
+class ServerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.session = urlquick.Session()
+
+    def tearDown(self):
+        self.session.close()
+
+    def route(self, *responses, **kwargs):
+        """Register the responses to serve, in order, at a url that is unique to the test."""
+        path = "/{}/{}".format(self.id(), time.time())
+        self.server.routes[path] = list(responses)
+        self.server.delays[path] = kwargs.get("delay", 0)
+        return "http://127.0.0.1:{}{}".format(self.server.server_port, path), path
+
+
+class TempCache(object):
+    """Give each test its own empty cache, so that tests don't see each other's cache files."""
+
+    def setUp(self):
+        super(TempCache, self).setUp()
+        handler = urlquick.CacheHandler
+        self.org_cache = handler._cache_dir, handler._cache_index, handler.memory, handler.initiate_cleanup
+        self.cache_dir = handler.safe_path(tempfile.mkdtemp())
+        handler._cache_dir, handler._cache_index = self.cache_dir, None
+        handler.memory = urlquick.MemoryCache(urlquick.MEMORY_CACHE_SIZE)
+        handler.initiate_cleanup = False
+
+    def tearDown(self):
+        handler = urlquick.CacheHandler
+        handler._cache_dir, handler._cache_index, handler.memory, handler.initiate_cleanup = self.org_cache
+        shutil.rmtree(self.cache_dir)
+        super(TempCache, self).tearDown()
+
+    @staticmethod
+    def store(url, body, headers=None, status=200):
+        """Store a response in the cache, returning its cache handler."""
+        cache = urlquick.CacheHandler.from_url(url)
+        cache.update(headers or {}, body, status, u"OK")
+        return cache
+
+
+class CacheFormat(unittest.TestCase):
+    def test_round_trip(self):
+        headers = {u"Content-Type": u"text/html", u"X-Title": u"Line\x85break", u":accept": u"text/html"}
+        data = urlquick.CacheHandler._encode(headers, b"data", 200, u"OK")
+        response, codec = urlquick.CacheHandler._decode(data)
+
+        self.assertEqual(codec, urlquick.CODEC_RAW)
+        self.assertEqual(response.body, b"data")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.reason, u"OK")
+        self.assertEqual(response.headers[u"x-title"], u"Line\x85break")
+        self.assertDictEqual(response.vary, {u"accept": u"text/html"})
+        self.assertNotIn(u":accept", response.headers)
+
+    def test_round_trip_zlib(self):
+        data = urlquick.CacheHandler._encode({}, zlib.compress(b"data"), 404, u"Not Found", codec=urlquick.CODEC_ZLIB)
+        response, codec = urlquick.CacheHandler._decode(data)
+
+        self.assertEqual(codec, urlquick.CODEC_ZLIB)
+        self.assertEqual(response.body, b"data")
+        self.assertEqual(response.status, 404)
+        self.assertEqual(len(response.headers), 0)
+
+    def test_truncated(self):
+        data = urlquick.CacheHandler._encode({}, b"data", 200, u"OK")
+        with self.assertRaises(ValueError):
+            urlquick.CacheHandler._decode(data[:-1])
+
+    def test_migrate(self):
+        uid = urlquick.CacheHandler.hash_url(u"http://127.0.0.1/migrate/{}".format(time.time()))
+        cache = urlquick.CacheHandler(uid)
+        self.assertFalse(cache)
+
+        legacy = {u"headers": {u"Content-Type": u"text/plain"}, u"body": u"ZGF0YQ==", u"status": 200,
+                  u"reason": u"OK", u"version": 11, u"strict": True}
+        cache.timestamp = timestamp = time.time() - 100
+        urlquick.make_dirs(os.path.dirname(cache.cache_file))
+        with open(cache.cache_file, "wb") as stream:
+            stream.write(json.dumps(legacy).encode("utf8"))
+
+        try:
+            response = cache._migrate(json.dumps(legacy).encode("utf8"))
+            self.assertEqual(response.body, b"data")
+            self.assertEqual(response.headers[u"content-type"], u"text/plain")
+
+            # The cache file is now stored in the binary format, with the age of the cache unchanged
+            with open(cache.cache_file, "rb") as stream:
+                self.assertEqual(stream.read(4), urlquick.CACHE_MAGIC)
+            self.assertAlmostEqual(os.stat(cache.cache_file).st_mtime, timestamp, places=0)
+        finally:
+            urlquick.CacheHandler.delete(cache.cache_file)
+
+
+class MemoryLRU(TempCache, unittest.TestCase):
+    @staticmethod
+    def response(body):
+        return urlquick.CacheResponse(urlquick.CaseInsensitiveDict(), body, 200, u"OK")
+
+    def test_evict_least_recently_used(self):
+        memory = urlquick.MemoryCache(10)
+        memory.put(u"a", self.response(b"aaaaaa"), 1)
+        memory.put(u"b", self.response(b"bbbb"), 2)
+        self.assertEqual(memory.get(u"a")[1], 1)
+
+        # "b" is now the least recently used
+        memory.put(u"c", self.response(b"cccc"), 3)
+        self.assertIsNone(memory.get(u"b"))
+        self.assertEqual(memory.get(u"a")[0].body, b"aaaaaa")
+        self.assertEqual(memory.get(u"c")[0].body, b"cccc")
+        self.assertEqual(memory.size, 10)
+
+    def test_too_large(self):
+        memory = urlquick.MemoryCache(10)
+        memory.put(u"a", self.response(b"a" * 11), 1)
+        self.assertIsNone(memory.get(u"a"))
+        self.assertEqual(memory.size, 0)
+
+    def test_replace(self):
+        memory = urlquick.MemoryCache(10)
+        memory.put(u"a", self.response(b"aaaa"), 1)
+        memory.put(u"a", self.response(b"aa"), 2)
+        response, timestamp = memory.get(u"a")
+        self.assertEqual(response.body, b"aa")
+        self.assertEqual(timestamp, 2)
+        self.assertEqual(memory.size, 2)
+
+    def test_hit_served_from_memory(self):
+        cache = self.store(u"http://127.0.0.1/memory", b"data")
+
+        # The cache file is never read on a memory hit
+        os.remove(cache.cache_file)
+        cached = urlquick.CacheHandler(cache.uid)
+        self.assertEqual(cached.response.body, b"data")
+        self.assertEqual(cached.timestamp, cache.timestamp)
+
+    def test_miss_loads_from_disk(self):
+        cache = self.store(u"http://127.0.0.1/memory", b"data")
+        urlquick.CacheHandler.memory.clear()
+
+        cached = urlquick.CacheHandler(cache.uid)
+        self.assertEqual(cached.response.body, b"data")
+        self.assertIsNotNone(urlquick.CacheHandler.memory.get(cache.uid))
+
+
+class Sharding(TempCache, unittest.TestCase):
+    def test_sharded_path(self):
+        cache = self.store(u"http://127.0.0.1/sharding", b"data")
+        self.assertEqual(cache.cache_file, os.path.join(self.cache_dir, cache.uid[6:8], cache.uid))
+        self.assertTrue(os.path.isfile(cache.cache_file))
+
+        record = urlquick.CacheHandler.cache_index().get(cache.uid)
+        self.assertEqual(record.size, os.path.getsize(cache.cache_file))
+        self.assertEqual(record.status, 200)
+
+    def test_delete(self):
+        cache = self.store(u"http://127.0.0.1/sharding", b"data")
+        urlquick.CacheHandler.delete(cache.cache_file)
+        self.assertFalse(os.path.exists(cache.cache_file))
+        self.assertIsNone(urlquick.CacheHandler.cache_index().get(cache.uid))
+        self.assertFalse(urlquick.CacheHandler(cache.uid))
+
+    def test_rebuild(self):
+        cache = self.store(u"http://127.0.0.1/sharding", b"data")
+        unsharded = urlquick.CacheHandler.hash_url(u"http://127.0.0.1/unsharded")
+        with open(os.path.join(self.cache_dir, unsharded), "wb") as stream:
+            stream.write(b"data")
+
+        # Left over from a write that never completed
+        with open(urlquick.temp_path(cache.cache_file), "wb") as stream:
+            stream.write(b"data")
+
+        os.remove(os.path.join(self.cache_dir, urlquick.CacheHandler.safe_path(u"index")))
+        index = urlquick.CacheIndex(self.cache_dir)
+
+        # The unsharded cache file is moved into its shard
+        self.assertTrue(os.path.isfile(urlquick.CacheHandler.cache_path(unsharded)))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, unsharded)))
+        self.assertListEqual(sorted(key for key, _ in index.items()),
+                             sorted(index._key(uid) for uid in (cache.uid, unsharded)))
+        self.assertEqual(index.size, os.path.getsize(cache.cache_file) + 4)
+
+
+class Index(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = urlquick.CacheHandler.safe_path(tempfile.mkdtemp())
+        self.index = urlquick.CacheIndex(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_reload(self):
+        self.index.add(u"cache-a", 100.0, 10, 200)
+        self.index.add(u"cache-b", 100.0, 20, 301)
+        self.index.add(u"cache-a", 200.0, 30, 200)
+        self.index.remove(u"cache-b")
+        self.index.remove(u"cache-missing")
+
+        index = urlquick.CacheIndex(self.cache_dir)
+        self.assertListEqual([key for key, _ in index.items()], [u"cache-a"])
+        self.assertEqual(index.get(u"cache-a").mtime, 200.0)
+        self.assertEqual(index.size, 30)
+
+    def test_corrupt_record(self):
+        self.index.add(u"cache-a", 100.0, 10, 200)
+        with open(self.index.path, "ab") as stream:
+            stream.write(b"cache-b corrupt\n")
+        self.index.add(u"cache-c", 100.0, 10, 200)
+
+        index = urlquick.CacheIndex(self.cache_dir)
+        self.assertListEqual(sorted(key for key, _ in index.items()), [u"cache-a", u"cache-c"])
+
+    def test_compact(self):
+        for _ in range(150):
+            self.index.add(u"cache-a", time.time(), 10, 200)
+        self.index.compact()
+
+        with open(self.index.path, "rb") as stream:
+            self.assertEqual(len(stream.read().splitlines()), 1)
+        self.assertEqual(urlquick.CacheIndex(self.cache_dir).get(u"cache-a").size, 10)
+
+    def test_touch_not_written(self):
+        self.index.add(u"cache-a", time.time(), 10, 200)
+        size = os.path.getsize(self.index.path)
+        for hits in range(1, 6):
+            self.assertEqual(self.index.touch(u"cache-a"), hits)
+        self.assertEqual(os.path.getsize(self.index.path), size)
+
+        # All accesses are written in one record
+        self.index.flush()
+        with open(self.index.path, "rb") as stream:
+            self.assertEqual(len(stream.read().splitlines()), 2)
+        self.assertEqual(urlquick.CacheIndex(self.cache_dir).get(u"cache-a").hits, 5)
+
+    def test_add_keeps_accesses(self):
+        self.index.add(u"cache-a", time.time(), 10, 200)
+        self.index.touch(u"cache-a")
+        self.index.touch(u"cache-a")
+        self.assertEqual(self.index.hits(u"cache-a"), 2)
+
+        # The accesses are written with the updated record, and are not counted again by the next flush
+        self.index.add(u"cache-a", time.time(), 20, 200, hits=self.index.get(u"cache-a").hits)
+        self.index.flush()
+        self.assertEqual(urlquick.CacheIndex(self.cache_dir).get(u"cache-a").hits, 2)
+
+    def test_touch_mtime_written(self):
+        self.index.add(u"cache-a", 100.0, 10, 200)
+        self.index.touch(u"cache-a", 200.0)
+        record = urlquick.CacheIndex(self.cache_dir).get(u"cache-a")
+        self.assertEqual(record.mtime, 200.0)
+        self.assertEqual(record.hits, 1)
+
+    def test_maintenance_compacts(self):
+        for _ in range(200):
+            self.index.add(u"cache-a", time.time(), 10, 200)
+
+        org_index, org_cleanup = urlquick.CacheHandler._cache_index, urlquick.CacheHandler.initiate_cleanup
+        urlquick.CacheHandler._cache_index, urlquick.CacheHandler.initiate_cleanup = self.index, False
+        try:
+            self.assertTrue(urlquick.cache_maintenance())
+        finally:
+            urlquick.CacheHandler._cache_index, urlquick.CacheHandler.initiate_cleanup = org_index, org_cleanup
+
+        # The cache is well within its size, but the log is still compacted
+        with open(self.index.path, "rb") as stream:
+            self.assertEqual(len(stream.read().splitlines()), 1)
+
+
+class SharedIndex(unittest.TestCase):
+    """Two indexes on the same cache directory, as used by two processes."""
+
+    def setUp(self):
+        self.cache_dir = urlquick.CacheHandler.safe_path(tempfile.mkdtemp())
+        self.first = urlquick.CacheIndex(self.cache_dir)
+        self.second = urlquick.CacheIndex(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_records_shared(self):
+        self.first.add(u"cache-a", 100.0, 10, 200)
+        self.assertEqual(self.second.get(u"cache-a").size, 10)
+
+        self.second.remove(u"cache-a")
+        self.second.add(u"cache-b", 100.0, 20, 200)
+        self.assertIsNone(self.first.get(u"cache-a"))
+        self.assertEqual(self.first.get(u"cache-b").size, 20)
+        self.assertEqual(self.first.size, 20)
+
+    def test_compacted_by_other(self):
+        for _ in range(150):
+            self.first.add(u"cache-a", time.time(), 10, 200)
+        self.assertEqual(self.second.get(u"cache-a").size, 10)
+
+        # The log is replaced, so the other index must reload it from the start
+        self.first.compact()
+        self.first.add(u"cache-b", 100.0, 20, 200)
+        self.assertListEqual(sorted(key for key, _ in self.second.items()), [u"cache-a", u"cache-b"])
+        self.assertEqual(self.second.size, 30)
+
+    def test_partial_record(self):
+        self.first.add(u"cache-a", 100.0, 10, 200)
+        record = self.first._serialize([(u"cache-b", urlquick.CacheRecord(100.0, 20, 200, 100.0, 0, 0))])
+        with open(self.first.path, "ab") as stream:
+            stream.write(record[:10].encode("ascii"))
+
+        # The record is only read once it is complete
+        self.assertIsNone(self.second.get(u"cache-b"))
+        with open(self.first.path, "ab") as stream:
+            stream.write(record[10:].encode("ascii"))
+        self.assertEqual(self.second.get(u"cache-b").size, 20)
+
+
+class Eviction(TempCache, unittest.TestCase):
+    def setUp(self):
+        super(Eviction, self).setUp()
+        self.index = urlquick.CacheHandler.cache_index()
+
+    def record(self, key, atime, hits=0, status=200, flags=0):
+        self.index._update(key, urlquick.CacheRecord(100.0, 10, status, atime, hits, flags))
+
+    def test_lru_order(self):
+        self.record(u"cache-a", 300.0, hits=5)
+        self.record(u"cache-b", 100.0)
+        self.record(u"cache-c", 200.0)
+        self.record(u"cache-forever", 0.0, flags=urlquick.CacheRecord.PROTECTED)
+        self.record(u"cache-redirect", 50.0, status=301)
+
+        # Protected entries are always last
+        self.assertListEqual(self.index.eviction_candidates(u"lru"),
+                             [u"cache-b", u"cache-c", u"cache-a", u"cache-forever", u"cache-redirect"])
+
+    def test_lfu_order(self):
+        self.record(u"cache-a", 100.0, hits=5)
+        self.record(u"cache-b", 300.0, hits=1)
+        self.record(u"cache-c", 200.0, hits=1)
+        self.record(u"cache-forever", 0.0, flags=urlquick.CacheRecord.PROTECTED)
+
+        # Ties on the number of hits are broken by the last access time
+        self.assertListEqual(self.index.eviction_candidates(u"lfu"),
+                             [u"cache-c", u"cache-b", u"cache-a", u"cache-forever"])
+
+    def test_within_size(self):
+        cache = self.store(u"http://127.0.0.1/evict", os.urandom(1000))
+        self.assertTrue(urlquick.cache_evict(self.index.size))
+        self.assertTrue(os.path.exists(cache.cache_file))
+
+    def test_evict(self):
+        first, second, third = [self.store(u"http://127.0.0.1/evict/{}".format(n), os.urandom(1000))
+                                for n in range(3)]
+
+        # The access is only held in memory, but must still be seen by the eviction
+        self.index.touch(first.uid)
+        self.assertTrue(urlquick.cache_evict(self.index.size - 1, u"lru"))
+
+        self.assertFalse(os.path.exists(second.cache_file))
+        self.assertIsNone(self.index.get(second.uid))
+        self.assertIsNone(urlquick.CacheHandler.memory.get(second.uid))
+        for cache in (first, third):
+            self.assertTrue(os.path.exists(cache.cache_file))
+            self.assertIsNotNone(self.index.get(cache.uid))
+
+    def test_evict_deadline(self):
+        caches = [self.store(u"http://127.0.0.1/evict/{}".format(n), os.urandom(1000)) for n in range(3)]
+        self.assertFalse(urlquick.cache_evict(1, deadline=time.time() - 1))
+        self.assertTrue(all(os.path.exists(cache.cache_file) for cache in caches))
+
+
+class Maintenance(TempCache, unittest.TestCase):
+    def stale(self):
+        """Store a response that is older than the cleanup age."""
+        cache = self.store(u"http://127.0.0.1/maintenance/stale", b"data")
+        urlquick.CacheHandler.cache_index().touch(cache.uid, time.time() - 60 * 60 * 24 * 15)
+        return cache
+
+    def test_nothing_due(self):
+        cache = self.stale()
+        self.assertTrue(urlquick.cache_maintenance())
+        self.assertTrue(os.path.exists(cache.cache_file))
+
+    def test_cleanup(self):
+        stale = self.stale()
+        fresh = self.store(u"http://127.0.0.1/maintenance/fresh", b"data")
+        urlquick.CacheHandler.initiate_cleanup = True
+
+        self.assertTrue(urlquick.cache_maintenance())
+        self.assertFalse(os.path.exists(stale.cache_file))
+        self.assertTrue(os.path.exists(fresh.cache_file))
+        self.assertFalse(urlquick.CacheHandler.initiate_cleanup)
+
+    def test_cleanup_deadline(self):
+        cache = self.stale()
+        urlquick.CacheHandler.initiate_cleanup = True
+
+        # The cleanup is left for the next call
+        self.assertFalse(urlquick.cache_maintenance(deadline=time.time() - 1))
+        self.assertTrue(os.path.exists(cache.cache_file))
+        self.assertTrue(urlquick.CacheHandler.initiate_cleanup)
+
+        self.assertTrue(urlquick.cache_maintenance())
+        self.assertFalse(os.path.exists(cache.cache_file))
+
+    def test_evict(self):
+        caches = [self.store(u"http://127.0.0.1/maintenance/{}".format(n), os.urandom(1000)) for n in range(3)]
+        org_size, urlquick.MAX_CACHE_SIZE = urlquick.MAX_CACHE_SIZE, 2000
+        try:
+            self.assertTrue(urlquick.cache_maintenance())
+        finally:
+            urlquick.MAX_CACHE_SIZE = org_size
+        self.assertLessEqual(urlquick.CacheHandler.cache_index().size, 1800)
+        self.assertEqual(sum(os.path.exists(cache.cache_file) for cache in caches), 1)
+
+
+class Compression(TempCache, unittest.TestCase):
+    @staticmethod
+    def stored(cache):
+        """Return the (response, codec) stored in the cache file."""
+        with open(cache.cache_file, "rb") as stream:
+            return urlquick.CacheHandler._decode(stream.read())
+
+    def test_zlib_at_rest(self):
+        body = b"data" * 1000
+        cache = self.store(u"http://127.0.0.1/compression", body)
+        response, codec = self.stored(cache)
+        self.assertEqual(codec, urlquick.CODEC_ZLIB)
+        self.assertEqual(response.body, body)
+        self.assertLess(os.path.getsize(cache.cache_file), len(body))
+
+        urlquick.CacheHandler.memory.clear()
+        self.assertEqual(urlquick.CacheHandler(cache.uid).response.body, body)
+
+    def test_wire_encoding_kept(self):
+        body = zlib.compress(b"data" * 1000)
+        cache = self.store(u"http://127.0.0.1/compression", body, {u"Content-Encoding": u"deflate"})
+        response, codec = self.stored(cache)
+        self.assertEqual(codec, urlquick.CODEC_RAW)
+        self.assertEqual(response.body, body)
+
+    def test_hot_promotion(self):
+        body = b"data" * 1000
+        cache = self.store(u"http://127.0.0.1/compression", body)
+        for _ in range(urlquick.CACHE_HOT_HITS - 1):
+            urlquick.CacheHandler.memory.clear()
+            urlquick.CacheHandler(cache.uid)
+        self.assertEqual(self.stored(cache)[1], urlquick.CODEC_ZLIB)
+
+        # The hot cache file is stored decompressed, keeping the age of the cache
+        urlquick.CacheHandler.memory.clear()
+        self.assertEqual(urlquick.CacheHandler(cache.uid).response.body, body)
+        response, codec = self.stored(cache)
+        self.assertEqual(codec, urlquick.CODEC_RAW)
+        self.assertEqual(response.body, body)
+        self.assertAlmostEqual(os.stat(cache.cache_file).st_mtime, cache.timestamp, places=1)
+
+    def test_hot_promotion_wire_encoding(self):
+        body = b"data" * 1000
+        cache = self.store(u"http://127.0.0.1/compression", zlib.compress(body), {u"Content-Encoding": u"deflate"})
+        for _ in range(urlquick.CACHE_HOT_HITS):
+            urlquick.CacheHandler.memory.clear()
+            urlquick.CacheHandler(cache.uid)
+
+        response, codec = self.stored(cache)
+        self.assertEqual(codec, urlquick.CODEC_RAW)
+        self.assertEqual(response.body, body)
+        self.assertNotIn(u"Content-Encoding", response.headers)
+
+
+class Freshness(unittest.TestCase):
+    @staticmethod
+    def cache(headers, age=0, max_age=urlquick.MAX_AGE, override=False):
+        cache = urlquick.CacheHandler(urlquick.CacheHandler.hash_url(u"http://127.0.0.1/freshness"), max_age, override)
+        cache.response = urlquick.CacheResponse(urlquick.CaseInsensitiveDict(headers), b"data", 200, u"OK")
+        cache.timestamp = time.time() - age
+        return cache
+
+    def test_max_age(self):
+        self.assertTrue(self.cache({u"Cache-Control": u"max-age=60"}, age=30).isfresh())
+        self.assertFalse(self.cache({u"Cache-Control": u"max-age=60"}, age=90).isfresh())
+
+    def test_max_age_override(self):
+        cache = self.cache({u"Cache-Control": u"max-age=60"}, age=90, max_age=120, override=True)
+        self.assertTrue(cache.isfresh())
+
+    def test_no_cache(self):
+        self.assertFalse(self.cache({u"Cache-Control": u"no-cache"}).isfresh())
+
+    def test_expires(self):
+        date = time.time()
+        headers = {u"Date": formatdate(date, usegmt=True),
+                   u"Expires": formatdate(date + 60, usegmt=True)}
+        self.assertTrue(self.cache(headers, age=30).isfresh())
+        self.assertFalse(self.cache(headers, age=90).isfresh())
+
+    def test_expires_invalid(self):
+        self.assertFalse(self.cache({u"Expires": u"0"}).isfresh())
+
+    def test_age(self):
+        # Time spent in upstream caches counts towards the age
+        self.assertFalse(self.cache({u"Cache-Control": u"max-age=60", u"Age": u"50"}, age=30).isfresh())
+        self.assertTrue(self.cache({u"Cache-Control": u"max-age=60", u"Age": u"10"}, age=30).isfresh())
+
+    def test_default_max_age(self):
+        self.assertTrue(self.cache({}, age=30, max_age=60).isfresh())
+        self.assertFalse(self.cache({}, age=90, max_age=60).isfresh())
+
+
+class StaleIfError(ServerTestCase):
+    def test_server_error(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0"}, b"cached"), (503, {}, b"error"))
+        self.assertEqual(self.session.get(url).content, b"cached")
+
+        resp = self.session.get(url, stale_if_error=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b"cached")
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_server_error_disabled(self):
+        url, _ = self.route((200, {"Cache-Control": "max-age=0"}, b"cached"), (503, {}, b"error"))
+        self.session.get(url)
+        self.assertEqual(self.session.get(url, raise_for_status=False).status_code, 503)
+
+    def test_must_revalidate(self):
+        url, _ = self.route((200, {"Cache-Control": "max-age=0, must-revalidate"}, b"cached"), (503, {}, b"error"))
+        self.session.get(url)
+        self.assertEqual(self.session.get(url, stale_if_error=True, raise_for_status=False).status_code, 503)
+
+
+class StaleWhileRevalidate(ServerTestCase):
+    def setUp(self):
+        super(StaleWhileRevalidate, self).setUp()
+        urlquick._pending_revalidation.clear()
+
+    def tearDown(self):
+        urlquick._pending_revalidation.clear()
+        super(StaleWhileRevalidate, self).tearDown()
+
+    def test_stale_served(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0"}, b"old"),
+                               (200, {"Cache-Control": "max-age=60"}, b"new"))
+        self.session.get(url)
+
+        # The stale response is returned without a request, and refreshed later
+        self.assertEqual(self.session.get(url, stale_while_revalidate=True).content, b"old")
+        self.assertEqual(self.server.hits[path], 1)
+
+        self.assertTrue(urlquick.revalidate())
+        self.assertEqual(self.server.hits[path], 2)
+        self.assertEqual(self.session.get(url).content, b"new")
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_revalidate_deadline(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0"}, b"old"), (200, {}, b"new"))
+        self.session.get(url)
+        self.session.get(url, stale_while_revalidate=True)
+
+        # The refresh stays pending for the next call
+        self.assertFalse(urlquick.revalidate(deadline=time.time() - 1))
+        self.assertEqual(self.server.hits[path], 1)
+        self.assertTrue(urlquick.revalidate())
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_window(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0"}, b"old"), (200, {}, b"new"))
+        self.session.get(url)
+        time.sleep(0.2)
+
+        # The cache has been stale for longer than the window
+        self.assertEqual(self.session.get(url, stale_while_revalidate=0.1).content, b"new")
+        self.assertEqual(self.server.hits[path], 2)
+        self.assertEqual(len(urlquick._pending_revalidation), 0)
+
+    def test_must_revalidate(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0, must-revalidate"}, b"old"), (200, {}, b"new"))
+        self.session.get(url)
+        self.assertEqual(self.session.get(url, stale_while_revalidate=True).content, b"new")
+        self.assertEqual(self.server.hits[path], 2)
+
+
+class SingleFlight(ServerTestCase):
+    def fetch_all(self, url, headers_list):
+        results = []
+        threads = [threading.Thread(target=lambda h=h: results.append(self.session.get(url, headers=h).content))
+                   for h in headers_list]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=60"}, b"data"), delay=0.5)
+        self.assertListEqual(self.fetch_all(url, [None] * 3), [b"data"] * 3)
+        self.assertEqual(self.server.hits[path], 1)
+
+    def test_different_headers(self):
+        # The response depends on the header, so the requests must not share a response
+        url, path = self.route((200, {"Cache-Control": "max-age=60", "Vary": "Authorization"}, b"data"), delay=0.5)
+        self.fetch_all(url, [{"Authorization": "user1"}, {"Authorization": "user2"}])
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_different_options(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=60"}, b"data"), delay=0.5)
+        threads = [threading.Thread(target=self.session.get, args=(url,), kwargs={"max_age": max_age})
+                   for max_age in (None, 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_interrupted_leader(self):
+        url, _ = self.route((200, {}, b"data"))
+        started = threading.Event()
+
+        def interrupted(*_):
+            started.set()
+            time.sleep(0.5)
+            raise SystemExit()
+
+        def leader():
+            try:
+                self.session.get(url)
+            except SystemExit:
+                pass
+
+        self.session._make_request = interrupted
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+
+        # The waiting request is released with an error, instead of waiting forever
+        with self.assertRaises(urlquick.UrlError):
+            self.session.get(url)
+        thread.join()
+
+
+class FetchAll(ServerTestCase):
+    def test_order(self):
+        # The first request finishes last, but the responses keep the order of the urls
+        routes = [self.route((200, {}, body), delay=delay) for body, delay in ((b"a", 0.3), (b"b", 0), (b"c", 0.1))]
+        responses = self.session.fetch_all([url for url, _ in routes], max_age=-1)
+        self.assertListEqual([resp.content for resp in responses], [b"a", b"b", b"c"])
+
+    def test_unordered(self):
+        routes = [self.route((200, {}, body), delay=delay) for body, delay in ((b"a", 0.3), (b"b", 0))]
+        results = list(self.session.map([{"url": url, "max_age": -1} for url, _ in routes], ordered=False))
+        self.assertListEqual([index for index, _ in results], [1, 0])
+        self.assertListEqual([resp.content for _, resp in results], [b"b", b"a"])
+
+    def test_error(self):
+        ok, _ = self.route((200, {}, b"data"))
+        missing, _ = self.route((404, {}, b"missing"))
+        with self.assertRaises(urlquick.HTTPError):
+            self.session.fetch_all([ok, missing], max_age=-1)
+
+    def test_cached(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=60"}, b"data"))
+        self.session.get(url)
+        self.assertListEqual([resp.content for resp in self.session.fetch_all([url, url])], [b"data", b"data"])
+        self.assertEqual(self.server.hits[path], 1)
+
+
+class StreamCache(ServerTestCase):
+    def test_stream_fresh_cache(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=60"}, b"0123456789"))
+        self.assertEqual(self.session.get(url).content, b"0123456789")
+
+        # The cached response is shared, so each stream must read from its own position
+        first = self.session.get(url, stream=True)
+        second = self.session.get(url, stream=True)
+        self.assertListEqual(list(first.iter_content(4)), [b"0123", b"4567", b"89"])
+        self.assertEqual(b"".join(second.iter_content(3)), b"0123456789")
+        self.assertEqual(self.session.get(url).content, b"0123456789")
+        self.assertEqual(self.server.hits[path], 1)
+
+    def test_stream_revalidated_cache(self):
+        url, path = self.route((200, {"Cache-Control": "max-age=0", "ETag": "tag"}, b"0123456789"),
+                               (304, {"ETag": "tag"}, b""))
+        self.session.get(url)
+
+        resp = self.session.get(url, stream=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.iter_content(4)), b"0123456789")
+        self.assertEqual(self.server.hits[path], 2)
+
+    def test_stream_stale_cache(self):
+        url, _ = self.route((200, {"Cache-Control": "max-age=0"}, b"0123456789"), (503, {}, b"error"))
+        self.session.get(url)
+
+        resp = self.session.get(url, stream=True, stale_if_error=True)
+        self.assertEqual(b"".join(resp.iter_content(4)), b"0123456789")
+
+
+class ParseCache(ServerTestCase):
+    def setUp(self):
+        super(ParseCache, self).setUp()
+
+        # Parser that finds the required element in the first chunk
+        class HTMLement(object):
+            def __init__(self, tag, attrs):
+                self._finished = False
+
+            def feed(self, data):
+                self._finished = True
+
+            def close(self):
+                return None
+
+        class htmlement(object):
+            pass
+
+        htmlement.HTMLement = HTMLement
+        self.org_module = sys.modules.get("htmlement")
+        sys.modules["htmlement"] = htmlement
+
+    def tearDown(self):
+        super(ParseCache, self).tearDown()
+        if self.org_module is None:
+            del sys.modules["htmlement"]
+        else:
+            sys.modules["htmlement"] = self.org_module
+
+    def test_early_stop_cached(self):
+        body = b"<html><body>" + b"<p>text</p>" * 1000 + b"</body></html>"
+        url, path = self.route((200, {"Cache-Control": "max-age=60", "Content-Type": "text/html"}, body))
+        self.session.get(url, stream=True).parse(u"p", chunk_size=64)
+
+        # The rest of the document was read into the cache
+        self.assertEqual(self.session.get(url).content, body)
+        self.assertEqual(self.server.hits[path], 1)
+
+    def test_early_stop_uncached(self):
+        url, path = self.route((200, {"Cache-Control": "no-store", "Content-Type": "text/html"}, b"<p>text</p>" * 1000))
+        self.session.get(url, stream=True).parse(u"p", chunk_size=64)
+        self.session.get(url)
+        self.assertEqual(self.server.hits[path], 2)
+
+
+class PoolSlots(ServerTestCase):
+    def setUp(self):
+        self.session = urlquick.Session(max_connections=1)
+
+    def active(self, url):
+        req = urlquick.Request("GET", url, {})
+        return self.session.pool._active[(req.type, req.host, False)]
+
+    def test_release_on_success(self):
+        url, _ = self.route((200, {}, b"data"))
+        for _ in range(3):
+            resp = self.session.get(url, max_age=-1, stream=True, timeout=2)
+            self.assertEqual(resp.content, b"data")
+        self.assertEqual(self.active(url), 0)
+
+    def test_release_on_error(self):
+        url, _ = self.route((404, {}, b"missing"))
+        for _ in range(3):
+            with self.assertRaises(urlquick.HTTPError):
+                self.session.get(url, max_age=-1, stream=True, timeout=2)
+        self.assertEqual(self.active(url), 0)
+
+    def test_checkout_timeout(self):
+        url, _ = self.route((200, {}, b"data"))
+        resp = self.session.get(url, max_age=-1, stream=True)
+        try:
+            # The only connection slot is held by the unread stream
+            start = time.time()
+            with self.assertRaises(urlquick.Timeout):
+                self.session.get(url, max_age=-1, timeout=0.2)
+            self.assertLess(time.time() - start, 2)
+        finally:
+            resp.close()
+        self.assertEqual(self.session.get(url, max_age=-1).content, b"data")